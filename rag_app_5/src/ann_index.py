@@ -0,0 +1,237 @@
+# ann_index.py
+import logging
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_FLAT = "flat"
+INDEX_IVF_FLAT = "ivf_flat"
+INDEX_IVF_PQ = "ivf_pq"
+INDEX_HNSW = "hnsw"
+INDEX_TYPES = [INDEX_FLAT, INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_HNSW]
+
+# How the vectors themselves are stored in the index
+COMPRESSION_NONE = "none"
+COMPRESSION_INT8 = "int8"
+COMPRESSION_PQ = "pq"
+COMPRESSIONS = [COMPRESSION_NONE, COMPRESSION_INT8, COMPRESSION_PQ]
+
+# k-means wants at least this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+MAX_TRAINING_POINTS_PER_CENTROID = 256
+# The int8 scalar quantizer clips each dimension to the range seen in training, so it needs a broad sample
+SQ_TRAINING_POINTS = 100_000
+REPORT_QUERIES = 200
+REPORT_K = 5
+# Search parameters are raised at build time until this recall@5 is reached
+TARGET_RECALL = float(os.getenv("RAGBOT_ANN_TARGET_RECALL", "0.95"))
+MAX_EF_SEARCH = 1024
+# Candidates fetched per result when re-scoring with full-precision vectors
+RESCORE_FACTOR = int(os.getenv("RAGBOT_RESCORE_FACTOR", "4"))
+
+
+def ivf_nlist(count):
+    """About 4*sqrt(n) lists, but never fewer than MIN_POINTS_PER_CENTROID vectors per list."""
+    return max(1, min(int(4 * math.sqrt(count)), count // MIN_POINTS_PER_CENTROID))
+
+
+def pq_subquantizers(dim):
+    """Largest number of sub-vectors of at least 4 dimensions that divides `dim` (16x smaller than float32)."""
+    for m in range(max(1, dim // 4), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def auto_params(index_type, compression, count, dim):
+    """Parameters for `index_type` and `compression` sized for `count` vectors of `dim` dimensions."""
+    params = {}
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        nlist = ivf_nlist(count)
+        params.update(nlist=nlist, nprobe=min(nlist, max(8, nlist // 16)))
+    elif index_type == INDEX_HNSW:
+        params.update(M=32, ef_construction=200 if count < 1_000_000 else 100, ef_search=64)
+    if compression == COMPRESSION_PQ:
+        params["m"] = pq_subquantizers(dim)
+        # 2**nbits codewords per sub-quantizer, each needing training points
+        params["nbits"] = max(1, min(8, int(math.log2(max(2, count // MIN_POINTS_PER_CENTROID)))))
+    return params
+
+
+def resolve_index_spec(index_type, count, dim, compression=COMPRESSION_NONE, rescore=False, overrides=None):
+    """Return {"type", "compression", "rescore", "params"} for the build.
+
+    IVF-PQ always stores PQ codes. Corpora too small to train on fall back
+    to a flat uncompressed index, and HNSW is built over int8 codes when PQ
+    is asked for, since building its graph over PQ codes is impractically slow.
+    """
+    if index_type == INDEX_IVF_PQ:
+        compression = COMPRESSION_PQ
+    if index_type == INDEX_HNSW and compression == COMPRESSION_PQ:
+        compression = COMPRESSION_INT8
+    if count < 2 * MIN_POINTS_PER_CENTROID and (index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ)
+                                                 or compression == COMPRESSION_PQ):
+        logger.info(f"{count} vectors are too few to train {index_type}/{compression}, using a flat index")
+        index_type, compression = INDEX_FLAT, COMPRESSION_NONE
+    if compression == COMPRESSION_NONE:
+        rescore = False
+    return {"type": index_type, "compression": compression, "rescore": rescore,
+            "params": {**auto_params(index_type, compression, count, dim), **(overrides or {})}}
+
+
+def factory_string(spec):
+    """faiss.index_factory description of a spec, e.g. "IVF1024,SQ8"."""
+    params = spec["params"]
+    codes = {COMPRESSION_NONE: "Flat", COMPRESSION_INT8: "SQ8",
+             COMPRESSION_PQ: f"PQ{params.get('m')}x{params.get('nbits')}"}[spec.get("compression", COMPRESSION_NONE)]
+    if spec["type"] in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        return f"IVF{params['nlist']},{codes}"
+    if spec["type"] == INDEX_HNSW:
+        return f"HNSW{params['M']}" + ("" if codes == "Flat" else f",{codes}")
+    return codes
+
+
+def build_index(vectors, spec):
+    """Build a FAISS index of the given spec over `vectors` (rows keep their positions)."""
+    count, dim = vectors.shape
+    params = spec["params"]
+    index = faiss.index_factory(dim, factory_string(spec), faiss.METRIC_L2)
+    if spec["type"] == INDEX_HNSW:
+        index.hnsw.efConstruction = params["ef_construction"]
+        index.hnsw.efSearch = params["ef_search"]
+    if not index.is_trained:
+        centroids = max(params.get("nlist", 1), 2 ** params.get("nbits", 0))
+        sample_size = centroids * MAX_TRAINING_POINTS_PER_CENTROID
+        if spec.get("compression") == COMPRESSION_INT8:
+            sample_size = max(sample_size, SQ_TRAINING_POINTS)
+        sample_size = min(count, sample_size)
+        sample = vectors[np.random.default_rng(0).choice(count, sample_size, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+    if "nprobe" in params:
+        index.nprobe = params["nprobe"]
+    index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    return index
+
+
+class RescoringIndex:
+    """Re-ranks the candidates of a compressed index by exact distance.
+
+    `factor` * k candidates are fetched from `base` and scored against the
+    full-precision `vectors` (typically the memory-mapped vectors.f32, so
+    only the candidate rows are read). Other attributes are those of `base`.
+    """
+
+    def __init__(self, base, vectors, factor=RESCORE_FACTOR):
+        self.base = base
+        self.vectors = vectors
+        self.factor = factor
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def search(self, x, k):
+        _, candidates = self.base.search(x, k * self.factor)
+        distances = np.full((len(x), k), np.inf, dtype=np.float32)
+        ids = np.full((len(x), k), -1, dtype=np.int64)
+        for row, (query, found) in enumerate(zip(x, candidates)):
+            # Sorted so the rows are read from disk in order
+            found = np.sort(found[found >= 0])
+            exact = ((np.asarray(self.vectors[found]) - query) ** 2).sum(axis=1)
+            best = np.argsort(exact)[:k]
+            distances[row, :len(best)] = exact[best]
+            ids[row, :len(best)] = found[best]
+        return distances, ids
+
+
+def query_latencies(index, queries, k):
+    """Search one query at a time, as the app does, returning the results and per-query seconds."""
+    results, seconds = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        seconds.append(time.perf_counter() - start)
+        results.append(ids[0])
+    return np.array(results), np.array(seconds)
+
+
+def recall_at_k(exact, found):
+    """Share of the exact top-k that the approximate search also returned."""
+    return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(exact, found)]))
+
+
+def set_search_param(index, spec, value):
+    index = getattr(index, "base", index)
+    if spec["type"] == INDEX_HNSW:
+        index.hnsw.efSearch = spec["params"]["ef_search"] = value
+    else:
+        index.nprobe = spec["params"]["nprobe"] = value
+
+
+def held_out(results, query_ids, k):
+    """The first `k` results of each query other than the query's own vector."""
+    return np.array([row[row != query_id][:k] for row, query_id in zip(results, query_ids)])
+
+
+def evaluate_index(index, spec, vectors, k=REPORT_K, queries=REPORT_QUERIES, target_recall=TARGET_RECALL):
+    """Tune the search parameter of `index` and compare it with exact search.
+
+    A sample of the corpus vectors is used as queries, each held out of its
+    own ground truth and results, so that finding itself does not count
+    towards recall. nprobe (IVF) or efSearch (HNSW) is doubled until
+    recall@k reaches `target_recall`, stops improving or hits its maximum,
+    updating `spec`. Returns recall@k and p50/p99 latency of the index and
+    of a flat index over the same vectors (the index itself when it is flat).
+    """
+    count, dim = vectors.shape
+    sample_ids = np.random.default_rng(1).choice(count, min(queries, count), replace=False)
+    sample = np.ascontiguousarray(vectors[sample_ids], dtype=np.float32)
+    found, seconds = query_latencies(index, sample, k + 1)
+    found = held_out(found, sample_ids, k)
+    if spec["type"] == INDEX_FLAT and spec.get("compression", COMPRESSION_NONE) == COMPRESSION_NONE:
+        exact, flat_seconds = found, seconds
+    else:
+        flat = faiss.IndexFlatL2(dim)
+        flat.add(np.ascontiguousarray(vectors, dtype=np.float32))
+        exact, flat_seconds = query_latencies(flat, sample, k + 1)
+        exact = held_out(exact, sample_ids, k)
+
+    if spec["type"] in (INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_HNSW):
+        value, limit = ((spec["params"]["ef_search"], MAX_EF_SEARCH) if spec["type"] == INDEX_HNSW
+                        else (spec["params"]["nprobe"], spec["params"]["nlist"]))
+        recall = recall_at_k(exact, found)
+        while recall < target_recall and value < limit:
+            value = min(limit, value * 2)
+            set_search_param(index, spec, value)
+            found, seconds = query_latencies(index, sample, k + 1)
+            found = held_out(found, sample_ids, k)
+            # PQ codes cap recall however many lists are probed
+            previous, recall = recall, recall_at_k(exact, found)
+            if recall - previous < 0.005:
+                break
+    return {
+        "queries": len(sample),
+        f"recall_at_{k}": round(recall_at_k(exact, found), 4),
+        "p50_ms": round(float(np.percentile(seconds, 50)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(seconds, 99)) * 1000, 3),
+        "flat_p50_ms": round(float(np.percentile(flat_seconds, 50)) * 1000, 3),
+        "flat_p99_ms": round(float(np.percentile(flat_seconds, 99)) * 1000, 3),
+        "index_mb": round(len(faiss.serialize_index(getattr(index, "base", index))) / 2**20, 3),
+        "flat_mb": round(vectors.nbytes / 2**20, 3),
+    }
+
+
+def format_report(spec, report):
+    params = ", ".join(f"{name}={value}" for name, value in spec["params"].items())
+    compression = spec.get("compression", COMPRESSION_NONE)
+    if compression != COMPRESSION_NONE:
+        params = ", ".join(filter(None, [compression + (" + re-scoring" if spec.get("rescore") else ""), params]))
+    return (f"Index {spec['type']}" + (f" ({params})" if params else "") +
+            f": recall@{REPORT_K} {report[f'recall_at_{REPORT_K}']:.1%}, "
+            f"{report['index_mb']:.1f} MB in memory vs {report['flat_mb']:.1f} MB flat, "
+            f"p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms "
+            f"(flat: p50 {report['flat_p50_ms']:.2f} ms, p99 {report['flat_p99_ms']:.2f} ms)")
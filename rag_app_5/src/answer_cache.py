@@ -0,0 +1,102 @@
+# answer_cache.py
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# Cosine similarity above which a new question reuses a cached answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("RAGBOT_ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("RAGBOT_ANSWER_CACHE_SIZE", "5000"))
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    hits: int = 0
+
+
+def answer_cache_key(personality, registry, db_names, model):
+    """(personality, ((db, live version), ...), model): a new DB version gives a new key."""
+    return personality, tuple(sorted((db_name, registry.live_version(db_name)) for db_name in db_names)), model
+
+
+class SemanticAnswerCache:
+    """Answers of previous questions, found again by embedding similarity.
+
+    Entries are grouped by answer_cache_key. Looking up or storing a key
+    drops every group that was answered from another version of one of its
+    DBs, so answers never outlive the data they came from. At most
+    `max_entries` answers are kept, evicting from the least recently used
+    group first.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._groups = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _invalidate(self, key):
+        versions = dict(key[1])
+        for other in list(self._groups):
+            if any(db_name in versions and versions[db_name] != version for db_name, version in other[1]):
+                self._size -= len(self._groups.pop(other)["answers"])
+                logger.info(f"Dropped cached answers of {other[0]} for outdated {other[1]}")
+
+    def lookup(self, key, embedding, threshold=ANSWER_CACHE_THRESHOLD):
+        """Return (CachedAnswer, similarity) of the closest cached question within `threshold`, or None."""
+        vector = unit_vector(embedding)
+        with self._lock:
+            self._invalidate(key)
+            group = self._groups.get(key)
+            if group is None:
+                return None
+            self._groups.move_to_end(key)
+            similarities = group["vectors"] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                return None
+            cached = group["answers"][best]
+            cached.hits += 1
+            return cached, float(similarities[best])
+
+    def store(self, key, embedding, question, answer):
+        vector = unit_vector(embedding)
+        with self._lock:
+            self._invalidate(key)
+            group = self._groups.setdefault(key, {"vectors": np.empty((0, len(vector)), dtype=np.float32),
+                                                  "answers": []})
+            self._groups.move_to_end(key)
+            group["vectors"] = np.vstack([group["vectors"], vector])
+            group["answers"].append(CachedAnswer(question, answer))
+            self._size += 1
+            while self._size > self.max_entries:
+                oldest = next(iter(self._groups.values()))
+                oldest["vectors"] = oldest["vectors"][1:]
+                oldest["answers"].pop(0)
+                self._size -= 1
+                if not oldest["answers"]:
+                    self._groups.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"groups": len(self._groups), "answers": self._size,
+                    "hits": sum(cached.hits for group in self._groups.values() for cached in group["answers"])}
+
+
+def unit_vector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+@st.cache_resource
+def get_answer_cache():
+    """One answer cache per server process, shared by all sessions."""
+    return SemanticAnswerCache()
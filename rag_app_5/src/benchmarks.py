@@ -0,0 +1,175 @@
+# benchmarks.py
+"""Offline benchmarks for the ingestion and retrieval code paths.
+
+Run from this directory, e.g.:
+    python benchmarks.py chunker ~/.ragbot/context_folder/my_folder --threshold percentile
+    python benchmarks.py embeddings ~/.ragbot/context_folder/my_folder --threads 2,4,8
+    python benchmarks.py startup
+"""
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from onnx_embeddings import ONNX_THREADS
+from pdf_parser import parse_pdfs
+
+
+class CountingEmbeddings(Embeddings):
+    """Wraps an embedding model and counts the texts it embeds."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.texts = 0
+
+    def embed_documents(self, texts):
+        self.texts += len(texts)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        self.texts += 1
+        return self.embeddings.embed_query(text)
+
+
+def load_corpus(folder, limit=None):
+    paths = sorted(path for path in Path(folder).expanduser().iterdir() if path.is_file())[:limit]
+    return [Document(page_content=result.text, metadata={"source": result.name})
+            for result in parse_pdfs(paths) if result.ok]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def cosine(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def print_table(rows, headers):
+    widths = [max(len(str(row[i])) for row in [headers, *rows]) for i in range(len(headers))]
+    for row in [headers, *rows]:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def bench_chunker(args):
+    from langchain_experimental.text_splitter import SemanticChunker
+    from models import setup_embedding_model
+    from semantic_chunker import SentenceEmbeddingChunker, CHUNK_VECTORS_REUSE, CHUNK_VECTORS_REENCODE
+
+    documents = load_corpus(args.folder, args.limit)
+    model = setup_embedding_model()
+    print(f"{len(documents)} documents, threshold type '{args.threshold}'")
+
+    # Current path: SemanticChunker embeds sentences, FAISS.from_documents embeds the chunks again
+    counter = CountingEmbeddings(model)
+    def baseline():
+        chunks = SemanticChunker(counter, breakpoint_threshold_type=args.threshold).split_documents(documents)
+        return chunks, counter.embed_documents([chunk.page_content for chunk in chunks])
+    (baseline_chunks, _), baseline_seconds = timed(baseline)
+    rows = [["SemanticChunker + re-embed", f"{baseline_seconds:.2f}", counter.texts, len(baseline_chunks), "100.0%"]]
+
+    baseline_texts = {chunk.page_content for chunk in baseline_chunks}
+    vectors = {}
+    for mode in [CHUNK_VECTORS_REUSE, CHUNK_VECTORS_REENCODE]:
+        counter = CountingEmbeddings(model)
+        chunker = SentenceEmbeddingChunker(counter, breakpoint_threshold_type=args.threshold, chunk_vectors=mode)
+        pairs, seconds = timed(lambda: list(chunker.iter_chunks_with_vectors(documents)))
+        vectors[mode] = np.asarray([vector for _, vector in pairs])
+        same = sum(chunk.page_content in baseline_texts for chunk, _ in pairs) / max(1, len(pairs))
+        rows.append([f"SentenceEmbeddingChunker ({mode})", f"{seconds:.2f}", counter.texts, len(pairs),
+                     f"{same:.1%}"])
+
+    print_table(rows, ["chunker", "seconds", "texts embedded", "chunks", "chunks identical to baseline"])
+    if len(vectors[CHUNK_VECTORS_REUSE]):
+        agreement = cosine(vectors[CHUNK_VECTORS_REUSE], vectors[CHUNK_VECTORS_REENCODE])
+        print(f"Cosine(reused, re-encoded chunk vectors): mean {agreement.mean():.4f}, "
+              f"p5 {np.percentile(agreement, 5):.4f}, min {agreement.min():.4f}")
+
+
+def bench_embeddings(args):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from models import EMBEDDING_MODEL, load_embedding_model
+    from onnx_embeddings import OnnxEmbeddings
+
+    documents = load_corpus(args.folder, args.limit)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    texts = [chunk.page_content for chunk in splitter.split_documents(documents)][:args.texts]
+    queries = texts[:args.queries]
+    print(f"{len(texts)} chunks from {len(documents)} documents, {len(queries)} single-text queries")
+
+    def measure(name, model):
+        model.embed_documents(texts[:8])  # warm-up
+        vectors, seconds = timed(lambda: model.embed_documents(texts))
+        latencies = [timed(lambda: model.embed_query(query))[1] for query in queries]
+        return name, np.asarray(vectors), seconds, latencies
+
+    results = [measure("torch", load_embedding_model("torch"))]
+    for threads in [int(value) for value in args.threads.split(",")]:
+        for quantize in [False, True]:
+            name = f"onnx{'-int8' if quantize else ''} ({threads} threads)"
+            results.append(measure(name, OnnxEmbeddings(EMBEDDING_MODEL, quantize=quantize, threads=threads)))
+
+    reference = results[0][1]
+    rows = []
+    for name, vectors, seconds, latencies in results:
+        agreement = cosine(vectors, reference)
+        rows.append([name, f"{len(texts) / seconds:.1f}", f"{np.percentile(latencies, 50) * 1000:.1f}",
+                     f"{np.percentile(latencies, 99) * 1000:.1f}", f"{agreement.mean():.5f}", f"{agreement.min():.5f}"])
+    print_table(rows, ["backend", "chunks/s", "query p50 ms", "query p99 ms", "cosine vs torch", "min cosine"])
+
+
+def bench_startup(args):
+    from startup import format_report, startup_report, warm_up
+
+    rows = []
+    for module in args.modules.split(","):
+        # A fresh interpreter per module, so that nothing is imported yet
+        code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        rows.append([module, f"{float(output.split()[-1]):.2f}"])
+    print_table(rows, ["cold import", "seconds"])
+    print()
+    warm_up()
+    print_table([[phase, f"{seconds:.2f}"] for phase, seconds in startup_report()], ["warm-up phase", "seconds"])
+    print(f"\n{format_report(startup_report())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    chunker = subparsers.add_parser("chunker", help="SemanticChunker vs SentenceEmbeddingChunker on a PDF folder")
+    chunker.add_argument("folder")
+    chunker.add_argument("--threshold", default="percentile",
+                         choices=["percentile", "standard_deviation", "interquartile", "gradient"])
+    chunker.add_argument("--limit", type=int, default=None, help="Only use the first N files")
+    chunker.set_defaults(run=bench_chunker)
+
+    embeddings = subparsers.add_parser("embeddings", help="PyTorch vs ONNX Runtime (fp32 and int8) embedding backends")
+    embeddings.add_argument("folder")
+    embeddings.add_argument("--limit", type=int, default=None, help="Only use the first N files")
+    embeddings.add_argument("--texts", type=int, default=512, help="Number of chunks to embed")
+    embeddings.add_argument("--queries", type=int, default=50, help="Number of chunks embedded one at a time")
+    embeddings.add_argument("--threads", default=str(ONNX_THREADS),
+                            help="Comma-separated intra-op thread counts to try")
+    embeddings.set_defaults(run=bench_embeddings)
+
+    startup = subparsers.add_parser("startup", help="Cold import times of the app modules and the warm-up phases")
+    startup.add_argument("--modules", default="models,vector_store,template,img2txt",
+                         help="Comma-separated modules to import in a fresh interpreter")
+    startup.set_defaults(run=bench_startup)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# chain_registry.py
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# Entries unused for this long are dropped, closing their connection pools once nothing refers to them
+CHAIN_IDLE_SECONDS = int(os.getenv("RAGBOT_CHAIN_IDLE_SECONDS", "1800"))
+
+
+def params_key(params):
+    """Hashable form of constructor kwargs; secrets are only kept as a digest."""
+    return tuple(sorted((name, hashlib.sha256(str(value).encode("utf-8")).hexdigest() if name == "api_key" else value)
+                        for name, value in params.items()))
+
+
+class ChainRegistry:
+    """Process-wide cache of LLM clients and compiled chains, reused across reruns and sessions.
+
+    Streamlit reruns the page script on every interaction; without this each
+    rerun built a new client (and HTTP connection pool) and recompiled the
+    chain. Entries are keyed by everything they are built from and dropped
+    after `idle_seconds` without use.
+    """
+
+    def __init__(self, idle_seconds=CHAIN_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, build):
+        """The entry for `key`, built with `build()` if there is none."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = now
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # Built outside the lock: clients may validate keys or open connections
+        value = build()
+        with self._lock:
+            return self._entries.setdefault(key, [value, now])[0]
+
+    def client(self, cls, **params):
+        """A chat model client `cls(**params)`, shared by every session using the same model, settings and key."""
+        return self.get(("client", cls.__module__, cls.__name__, params_key(params)), lambda: cls(**params))
+
+    def _evict_idle(self, now):
+        for key, (_, last_used) in list(self._entries.items()):
+            if now - last_used > self.idle_seconds:
+                del self._entries[key]
+                logger.info(f"Evicted idle {key[0]} {key[1:3]}")
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+@st.cache_resource
+def get_chain_registry():
+    return ChainRegistry()
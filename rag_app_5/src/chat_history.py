@@ -0,0 +1,142 @@
+# chat_history.py
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage, get_buffer_string
+
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Default tokens of history sent with each question; personalities can set their own
+HISTORY_TOKEN_BUDGET = int(os.getenv("RAGBOT_HISTORY_TOKEN_BUDGET", "2000"))
+# Most recent question/answer pairs that are never summarised
+HISTORY_KEEP_TURNS = int(os.getenv("RAGBOT_HISTORY_KEEP_TURNS", "3"))
+SUMMARY_PROMPT = """Progressively summarise the conversation below, adding the new lines to the previous summary.
+Keep names, numbers, decisions and open questions. Answer with the new summary only, in at most {words} words.
+
+Previous summary:
+{summary}
+
+New lines:
+{lines}
+
+New summary:"""
+
+# Summaries are written after the answer is shown, never while the user waits
+_summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+
+def message_tokens(message):
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return count_tokens(content)
+
+
+class SummarizingChatHistory(BaseChatMessageHistory):
+    """Chat history that hands the chain at most `token_budget` tokens.
+
+    Every message is kept, but `messages` (what the chain sends to the LLM)
+    is a rolling summary of the older turns followed by as many recent
+    messages as fit the budget; the last `keep_turns` turns are never
+    summarised. Once the history exceeds the budget, the turns before those
+    are folded into the summary by `llm` on a background thread after the
+    answer has been delivered. Until then, or without an `llm`, the oldest
+    messages that do not fit are left out.
+    """
+
+    def __init__(self, token_budget=HISTORY_TOKEN_BUDGET, keep_turns=HISTORY_KEEP_TURNS, llm=None):
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.llm = llm
+        self.all_messages = []
+        self._tokens = []
+        self.summary = ""
+        self._summary_tokens = 0
+        # Number of leading messages folded into the summary
+        self.summarized = 0
+        self._epoch = 0
+        self._summarizing = None
+        self._lock = threading.Lock()
+
+    @property
+    def messages(self):
+        with self._lock:
+            recent = self.all_messages[self.summarized:]
+            budget = self.token_budget - self._summary_tokens
+            kept = used = 0
+            for tokens in reversed(self._tokens[self.summarized:]):
+                # The last exchange is always kept, even over budget
+                if used + tokens > budget and kept >= 2:
+                    break
+                used += tokens
+                kept += 1
+            recent = recent[len(recent) - kept:]
+            # Start on a question so that user and assistant turns still alternate
+            while recent and not isinstance(recent[0], HumanMessage):
+                recent = recent[1:]
+            if not self.summary:
+                return recent
+            return [HumanMessage(content=f"Summary of our conversation so far: {self.summary}"),
+                    AIMessage(content="Understood."), *recent]
+
+    def add_messages(self, messages):
+        with self._lock:
+            for message in messages:
+                self.all_messages.append(message)
+                self._tokens.append(message_tokens(message))
+        self._schedule_summary()
+
+    def clear(self):
+        with self._lock:
+            self.all_messages, self._tokens = [], []
+            self.summary, self._summary_tokens, self.summarized = "", 0, 0
+            self._epoch += 1
+
+    def _schedule_summary(self):
+        with self._lock:
+            if self.llm is None or (self._summarizing is not None and not self._summarizing.done()):
+                return
+            end = len(self.all_messages) - 2 * self.keep_turns
+            over_budget = self._summary_tokens + sum(self._tokens[self.summarized:]) > self.token_budget
+            if end <= self.summarized or not over_budget:
+                return
+            self._summarizing = _summary_pool.submit(self._summarize, end)
+
+    def _summarize(self, end):
+        with self._lock:
+            start, epoch, summary, llm = self.summarized, self._epoch, self.summary, self.llm
+            lines = get_buffer_string(self.all_messages[start:end])
+        began = time.perf_counter()
+        prompt = SUMMARY_PROMPT.format(words=max(50, self.token_budget // 6), summary=summary or "(none)", lines=lines)
+        try:
+            new_summary = llm.invoke(prompt).content
+        except Exception:
+            # Retried after the next answer; meanwhile old messages are left out of the prompt
+            logger.exception("Summarising chat history failed")
+            return
+        if not isinstance(new_summary, str):
+            new_summary = str(new_summary)
+        with self._lock:
+            if self._epoch != epoch or self.summarized != start:
+                return
+            self.summary = new_summary.strip()
+            self._summary_tokens = count_tokens(self.summary)
+            self.summarized = end
+        logger.info(f"Folded {end - start} messages into a {self._summary_tokens}-token summary "
+                    f"in {time.perf_counter() - began:.1f}s")
+
+
+def add_history_budget_column(engine):
+    """Add personalities.history_token_budget to databases created before it existed."""
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(engine)
+    if "personalities" not in inspector.get_table_names():
+        return
+    if "history_token_budget" not in {column["name"] for column in inspector.get_columns("personalities")}:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE personalities ADD COLUMN history_token_budget INTEGER"))
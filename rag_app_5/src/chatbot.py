@@ -4,6 +4,7 @@ from sqlalchemy import create_engine, Column, Integer, String, Text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import hashlib
+from chat_history import HISTORY_TOKEN_BUDGET, add_history_budget_column
 
 # SQLAlchemy setup
 Base = declarative_base()
@@ -16,8 +17,11 @@ class Personality(Base):
     system_prompt = Column(Text, nullable=False)
     system_prompt_rag = Column(Text, nullable=False)
     personality_title = Column(String(100), nullable=False)
+    # Tokens of chat history sent with each question; NULL uses HISTORY_TOKEN_BUDGET
+    history_token_budget = Column(Integer, nullable=True)
 
 engine = create_engine('sqlite:///personalities.db', echo=True)
+add_history_budget_column(engine)
 Session = sessionmaker(bind=engine)
 
 def load_personalities():
@@ -38,9 +42,10 @@ with st.sidebar:
         v_system_prompt = selected_personality.system_prompt
         v_system_prompt_rag = selected_personality.system_prompt_rag
         v_personality_title = selected_personality.personality_title
+        v_history_token_budget = selected_personality.history_token_budget or HISTORY_TOKEN_BUDGET
         hex_str = bytes(selected_personality_name, encoding='utf-8')
         session_hex = hashlib.sha256(hex_str).hexdigest()
         
 
-app = RAGChatAppTemplate(session_hex,v_system_prompt, v_system_prompt_rag)
+app = RAGChatAppTemplate(session_hex,v_system_prompt, v_system_prompt_rag, v_history_token_budget)
 app.run(f" #### {v_personality_title} ")
\ No newline at end of file
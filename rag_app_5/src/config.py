@@ -55,4 +55,16 @@ ANTHROPIC_VISION_MODELS = {
 
 OLLAMA_VISION_MODELS = {
     "LLAMA 3.2 Vision 11B": "llama3.2-vision"
-}
\ No newline at end of file
+}
+
+# Tokens of retrieved context packed into a RAG prompt (see context_packing); other models use RAGBOT_CONTEXT_TOKEN_BUDGET
+CONTEXT_TOKEN_BUDGETS = {
+    'gpt-4o-mini': 4000,
+    'gpt-4o': 4000,
+    'claude-3-5-haiku-20241022': 4000,
+    'open-mistral-nemo-2407': 2000,
+    'deepseek-r1:14b': 2000,
+    'phi4:latest': 2000,
+    'llama3.2:3b': 1500,
+    'qwen2.5:14b': 2000
+}
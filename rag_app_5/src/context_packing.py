@@ -0,0 +1,162 @@
+# context_packing.py
+import logging
+import os
+import re
+import threading
+import time
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+
+from config import CONTEXT_TOKEN_BUDGETS
+from embedding_cache import normalize_text
+from hybrid_search import TERM_PATTERN
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens of retrieved context per prompt for models without an entry in CONTEXT_TOKEN_BUDGETS
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAGBOT_CONTEXT_TOKEN_BUDGET", "3000"))
+# Longer chunks are cut down to the sentences around their best match
+CHUNK_TOKEN_LIMIT = int(os.getenv("RAGBOT_CHUNK_TOKEN_LIMIT", "400"))
+# A chunk that would have to be cut below this to fit the remaining budget is left out
+MIN_CHUNK_TOKENS = 50
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+def context_token_budget(model):
+    return CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+
+def query_terms(query):
+    return {term.lower() for term in TERM_PATTERN.findall(query) if len(term) > 2}
+
+
+def sentence_score(sentence, terms):
+    return len(terms & {term.lower() for term in TERM_PATTERN.findall(sentence)})
+
+
+def best_window(scores, tokens, limit):
+    """(start, end) of the contiguous sentences around the best-scoring one that fit in `limit` tokens."""
+    best = max(range(len(scores)), key=lambda i: (scores[i], -i))
+    start, end, used = best, best + 1, tokens[best]
+    while True:
+        candidates = [i for i in (start - 1, end) if 0 <= i < len(scores) and used + tokens[i] <= limit]
+        if not candidates:
+            return start, end
+        # Grow towards the more relevant neighbour, preferring what follows the match
+        i = max(candidates, key=lambda i: (scores[i], i))
+        used += tokens[i]
+        start, end = min(start, i), max(end, i + 1)
+
+
+class PackingStats:
+    """Token counts before and after packing, summed over the queries of the process."""
+
+    def __init__(self):
+        self.queries = self.tokens_in = self.tokens_out = 0
+        self._lock = threading.Lock()
+
+    def add(self, tokens_in, tokens_out):
+        with self._lock:
+            self.queries += 1
+            self.tokens_in += tokens_in
+            self.tokens_out += tokens_out
+
+    def as_dict(self):
+        with self._lock:
+            saved = self.tokens_in - self.tokens_out
+            return {"queries": self.queries, "tokens_in": self.tokens_in, "tokens_out": self.tokens_out,
+                    "tokens_saved": saved, "saved_ratio": saved / self.tokens_in if self.tokens_in else 0.0}
+
+
+packing_stats = PackingStats()
+
+
+def pack_context(query, documents, token_budget=CONTEXT_TOKEN_BUDGET, chunk_token_limit=CHUNK_TOKEN_LIMIT):
+    """Fit retrieved chunks, best first, into `token_budget` tokens.
+
+    Sentences already included from a better-ranked chunk are dropped
+    (overlapping or duplicate chunks), chunks longer than
+    `chunk_token_limit` (or than the remaining budget) are trimmed to the
+    sentences around the one matching most query terms, and chunks are
+    added in the order given until the budget is used up. Returns new
+    Documents and {"tokens_in", "tokens_out", "duplicate_tokens", "trimmed", "dropped"}.
+    """
+    terms = query_terms(query)
+    seen = set()
+    packed, used = [], 0
+    report = {"tokens_in": 0, "tokens_out": 0, "duplicate_tokens": 0, "trimmed": 0, "dropped": 0}
+    for document in documents:
+        sentences = split_sentences(document.page_content)
+        report["tokens_in"] += count_tokens(document.page_content)
+        keys = [normalize_text(sentence.lower()) for sentence in sentences]
+        unique = [(sentence, key) for sentence, key in zip(sentences, keys) if key not in seen]
+        report["duplicate_tokens"] += sum(count_tokens(sentence) for sentence, key in zip(sentences, keys) if key in seen)
+        remaining = token_budget - used
+        if not unique or remaining < MIN_CHUNK_TOKENS:
+            report["dropped"] += 1
+            continue
+        tokens = [count_tokens(sentence) for sentence, _ in unique]
+        limit = min(chunk_token_limit, remaining)
+        if sum(tokens) > limit:
+            start, end = best_window([sentence_score(sentence, terms) for sentence, _ in unique], tokens, limit)
+            if sum(tokens[start:end]) > limit:
+                # A single sentence larger than what is left
+                report["dropped"] += 1
+                continue
+            unique, tokens = unique[start:end], tokens[start:end]
+            report["trimmed"] += 1
+        seen.update(key for _, key in unique)
+        used += sum(tokens)
+        packed.append(Document(page_content=" ".join(sentence for sentence, _ in unique),
+                               metadata=dict(document.metadata), id=document.id))
+    report["tokens_out"] = used
+    return packed, report
+
+
+def pack_documents(query, documents, token_budget=CONTEXT_TOKEN_BUDGET, chunk_token_limit=CHUNK_TOKEN_LIMIT):
+    """The packed documents (see pack_context), with the metrics of the packing.
+
+    The packing latency is added to metadata["retrieval_ms"] and the token
+    counts to metadata["packing"]; process totals are in `packing_stats`.
+    """
+    if not documents:
+        return documents
+    start = time.perf_counter()
+    packed, report = pack_context(query, documents, token_budget, chunk_token_limit)
+    timings = {**documents[0].metadata.get("retrieval_ms", {}), "packing": (time.perf_counter() - start) * 1000}
+    for document in packed:
+        document.metadata["retrieval_ms"] = timings
+        document.metadata["packing"] = report
+    packing_stats.add(report["tokens_in"], report["tokens_out"])
+    logger.info(f"Packed {len(documents)} chunks into {len(packed)}: {report['tokens_in']} -> "
+                f"{report['tokens_out']} tokens ({report['duplicate_tokens']} duplicate, "
+                f"{report['trimmed']} trimmed, {report['dropped']} dropped)")
+    return packed
+
+
+def create_packing_retriever(history_aware_retriever, token_budget=CONTEXT_TOKEN_BUDGET,
+                             chunk_token_limit=CHUNK_TOKEN_LIMIT):
+    """Packs the final candidates of a history-aware retriever ({"input", "chat_history"} -> documents).
+
+    Packing runs once on whatever the retriever settles on, so the budget
+    and the sentence dedup hold however the candidates were gathered
+    (e.g. the two merged retrievals of speculative_retrieval).
+    """
+
+    def retrieve(inputs, config):
+        return pack_documents(inputs["input"], history_aware_retriever.invoke(inputs, config),
+                              token_budget, chunk_token_limit)
+
+    return RunnableLambda(retrieve).with_config(run_name="context_packing")
+
+
+def format_packing(report):
+    saved = report["tokens_in"] - report["tokens_out"]
+    return (f"{report['tokens_in']} → {report['tokens_out']} tokens (saved {saved}; "
+            f"{report['duplicate_tokens']} duplicate, {report['trimmed']} trimmed, {report['dropped']} dropped)")
@@ -0,0 +1,114 @@
+# dedup.py
+import logging
+import os
+import re
+import time
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NUM_PERMUTATIONS = 128
+# 16 bands of 8 rows: pairs with a Jaccard similarity above ~0.7 share a band with high probability
+LSH_BANDS = 16
+SHINGLE_WORDS = 5
+# Estimated Jaccard similarity of word shingles above which two chunks are the same text
+DEDUP_THRESHOLD = float(os.getenv("RAGBOT_DEDUP_THRESHOLD", "0.85"))
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class MinHasher:
+    """MinHash signatures of the word shingles of a text."""
+
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, seed=1):
+        rng = np.random.default_rng(seed)
+        # a < 2**31 and 32-bit shingle hashes keep a * h + b below 2**64
+        self.a = rng.integers(1, 1 << 31, num_permutations, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_permutations, dtype=np.uint64)
+
+    def shingles(self, text):
+        words = WORD_PATTERN.findall(text.lower())
+        grams = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+        return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+    def signature(self, text):
+        hashes = self.shingles(text)
+        # Universal hashing (a * h + b) mod p, truncated to 32 bits
+        permuted = ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME) & MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """LSH index of MinHash signatures, mapping near-identical texts to the first chunk id seen.
+
+    Signatures are split into `bands`; chunks sharing any band are
+    candidates, confirmed when their estimated Jaccard similarity reaches
+    `threshold`.
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, bands=LSH_BANDS, hasher=None):
+        self.threshold = threshold
+        self.hasher = hasher or MinHasher()
+        self.bands = bands
+        self.rows = NUM_PERMUTATIONS // bands
+        self._buckets = [{} for _ in range(bands)]
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    @property
+    def signatures(self):
+        """{id: signature} of every indexed chunk."""
+        return self._signatures
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def find(self, signature):
+        """Id of the most similar indexed chunk at or above the threshold, or None."""
+        candidates = {id_ for bucket, key in zip(self._buckets, self._band_keys(signature))
+                      for id_ in bucket.get(key, ())}
+        best, best_similarity = None, self.threshold
+        for id_ in candidates:
+            similarity = float(np.mean(self._signatures[id_] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = id_, similarity
+        return best
+
+    def add(self, id_, signature):
+        self._signatures[id_] = signature
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(id_)
+
+    def add_texts(self, items):
+        """Index (id, text) pairs, e.g. the chunks already in a DB."""
+        start = time.perf_counter()
+        for id_, text in items:
+            self.add(id_, self.hasher.signature(text))
+        logger.info(f"Indexed {len(self)} chunks for near-duplicate detection in {time.perf_counter() - start:.1f}s")
+        return self
+
+
+def chunk_sources(metadata):
+    """All files a chunk was found in: the surviving copy of near-duplicates lists each of them."""
+    return metadata.get("sources") or [metadata["source"]]
+
+
+def add_chunk_source(metadata, source):
+    sources = chunk_sources(metadata)
+    if source not in sources:
+        metadata["sources"] = [*sources, source]
+
+
+def remove_chunk_sources(metadata, removed):
+    """Drop `removed` files from a chunk's sources; "source" becomes the first remaining one."""
+    sources = [source for source in chunk_sources(metadata) if source not in removed]
+    if sources:
+        metadata["source"] = sources[0]
+        metadata["sources"] = sources
+        if len(sources) == 1:
+            del metadata["sources"]
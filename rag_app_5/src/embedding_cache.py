@@ -0,0 +1,237 @@
+# embedding_cache.py
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path.home()/".ragbot"/"embedding_cache"
+CACHE_MAX_MB = int(os.getenv("RAGBOT_EMBEDDING_CACHE_MB", "2048"))
+QUERY_CACHE_SIZE = int(os.getenv("RAGBOT_QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+MIN_CAPACITY = 1024
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def model_name_of(embeddings):
+    return (getattr(embeddings, "model_name", None) or getattr(embeddings, "model", None)
+            or type(embeddings).__name__)
+
+
+class EmbeddingCache:
+    """Persistent embedding cache for one model.
+
+    Vectors live in a memory-mapped float32 matrix (`vectors.f32`); a SQLite
+    index maps the hash of the normalised text to its row and tracks when it
+    was last used. Once the matrix holds more than `max_mb` of vectors the
+    least recently used rows are evicted and their slots reused. Row
+    allocation happens inside an IMMEDIATE transaction, so several processes
+    can share the cache directory.
+    """
+
+    def __init__(self, model_name, directory=CACHE_DIR, max_mb=CACHE_MAX_MB):
+        self.model_name = model_name
+        self.directory = Path(directory) / re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.directory / "vectors.f32"
+        self.max_bytes = max_mb * 2**20
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._db = sqlite3.connect(self.directory / "index.sqlite", timeout=60,
+                                   isolation_level=None, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+
+    def _meta(self, name, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, name, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def _map(self, min_rows=0):
+        """Return the vector matrix, remapping it if the file has grown (possibly in another process)."""
+        dim, capacity = self._meta("dim"), self._meta("capacity", 0)
+        if self._vectors is None or len(self._vectors) < max(capacity, min_rows):
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        return self._vectors
+
+    def _rows_for(self, keys):
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            found.update(self._db.execute(
+                f"SELECT key, row FROM entries WHERE key IN ({','.join('?' * len(part))})", part).fetchall())
+        return found
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys present in the cache."""
+        if not keys:
+            return {}
+        with self._lock:
+            found = self._rows_for(keys)
+            if not found:
+                self.misses += len(keys)
+                return {}
+            vectors = self._map(max(found.values()) + 1)
+            result = {key: np.array(vectors[row]) for key, row in found.items()}
+            now = time.time()
+            self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            hits = sum(key in result for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            return result
+
+    def put_many(self, items):
+        """Store {key: vector}, evicting the least recently used entries when over budget."""
+        if not items:
+            return
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                dim = self._meta("dim")
+                if dim is None:
+                    dim = len(next(iter(items.values())))
+                    self._set_meta("dim", dim)
+                existing = self._rows_for(items)
+                new_keys = [key for key in items if key not in existing]
+                rows = self._allocate(len(new_keys), dim)
+                vectors = self._map(max(rows, default=-1) + 1)
+                for key, row in zip(new_keys, rows):
+                    vectors[row] = items[key]
+                vectors.flush()
+                now = time.time()
+                self._db.executemany("INSERT INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                                     [(key, row, now) for key, row in zip(new_keys, rows)])
+                self._evict(dim)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _allocate(self, count, dim):
+        rows = [row for (row,) in self._db.execute("SELECT row FROM free_rows LIMIT ?", (count,))]
+        self._db.executemany("DELETE FROM free_rows WHERE row = ?", [(row,) for row in rows])
+        next_row = self._meta("next_row", 0)
+        rows += range(next_row, next_row + count - len(rows))
+        self._set_meta("next_row", max(next_row, max(rows, default=-1) + 1))
+
+        capacity = self._meta("capacity", 0)
+        needed = self._meta("next_row")
+        if needed > capacity:
+            capacity = max(MIN_CAPACITY, needed, capacity * 2)
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(capacity * dim * 4)
+            self._set_meta("capacity", capacity)
+        return rows
+
+    def _evict(self, dim):
+        max_entries = max(1, self.max_bytes // (dim * 4))
+        excess = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - max_entries
+        if excess <= 0:
+            return
+        evicted = self._db.execute("SELECT key, row FROM entries ORDER BY last_used LIMIT ?", (excess,)).fetchall()
+        self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+        self._db.executemany("INSERT INTO free_rows (row) VALUES (?)", [(row,) for _, row in evicted])
+        logger.info(f"Evicted {len(evicted)} entries from the {self.model_name} embedding cache")
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            dim = self._meta("dim", 0)
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "size_mb": entries * dim * 4 / 2**20,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves document embeddings from an EmbeddingCache.
+
+    Only `embed_documents` goes through the cache; queries are passed straight
+    to the wrapped model.
+    """
+
+    def __init__(self, embeddings, cache=None):
+        self.embeddings = embeddings
+        self.model_name = model_name_of(embeddings)
+        self.cache = cache or EmbeddingCache(self.model_name)
+
+    def embed_documents(self, texts):
+        keys = [text_key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, vectors)}
+            self.cache.put_many(computed)
+            cached.update(computed)
+        return [cached[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+class LRUQueryEmbeddings(Embeddings):
+    """Embeddings wrapper that keeps the most recent query embeddings in memory.
+
+    Keys are (model, normalised text), so the same question asked again from
+    any session skips the model. Documents are passed straight through.
+    """
+
+    def __init__(self, embeddings, max_size=QUERY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.model_name = model_name_of(embeddings)
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = (self.model_name, normalize_text(text))
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return list(vector)
+            self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        with self._lock:
+            self._cache[key] = tuple(vector)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return vector
@@ -0,0 +1,273 @@
+# embedding_service.py
+"""Local embedding service: one model copy shared by every app process and ingestion job.
+
+Start it with:
+    python embedding_service.py [--socket ~/.ragbot/embedding.sock] [--backend torch|onnx|onnx-int8]
+and point the app at it with RAGBOT_EMBEDDING_SERVICE=<socket path>.
+
+Concurrent requests are coalesced into dynamic batches: the batcher waits
+at most `max_wait_ms` after the first pending text for others to arrive,
+up to `max_batch_size` texts, and embeds them sorted by length so that
+little padding is computed.
+
+Wire format, both ways: a 4-byte big-endian length and a JSON header. A
+request header is {"op": "embed", "texts": [...]}, {"op": "info"} or
+{"op": "stats"}; the response to "embed" is followed by count * dim
+float32 values.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = Path.home() / ".ragbot" / "embedding.sock"
+MAX_BATCH_SIZE = int(os.getenv("RAGBOT_BATCH_MAX_SIZE", "64"))
+MAX_WAIT_MS = float(os.getenv("RAGBOT_BATCH_MAX_WAIT_MS", "5"))
+HEADER = struct.Struct(">I")
+METRICS_WINDOW = 1000
+
+
+def send_frame(sock, header, payload=b""):
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data + payload)
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Embedding service connection closed")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return json.loads(recv_exactly(sock, size))
+
+
+class DynamicBatcher:
+    """Embeds texts submitted from many threads in shared batches on one worker thread."""
+
+    def __init__(self, embeddings, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._batch_sizes = deque(maxlen=METRICS_WINDOW)
+        self._batch_seconds = deque(maxlen=METRICS_WINDOW)
+        self._queue_seconds = deque(maxlen=METRICS_WINDOW)
+        self.texts = self.batches = 0
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def submit(self, texts):
+        """Future of the vectors of `texts`, as an (n, dim) float32 array."""
+        future = Future()
+        if not texts:
+            future.set_result(np.empty((0, 0), dtype=np.float32))
+            return future
+        request = {"future": future, "vectors": [None] * len(texts), "remaining": len(texts)}
+        now = time.perf_counter()
+        with self._cond:
+            self._pending.extend((request, i, text, now) for i, text in enumerate(texts))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.perf_counter() + self.max_wait
+            while len(self._pending) < self.max_batch_size and (remaining := deadline - time.perf_counter()) > 0:
+                self._cond.wait(remaining)
+            return [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            batch.sort(key=lambda item: len(item[2]))
+            try:
+                vectors = self.embeddings.embed_documents([text for _, _, text, _ in batch])
+            except Exception as e:
+                logger.exception("Embedding batch failed")
+                for request, _, _, _ in batch:
+                    if not request["future"].done():
+                        request["future"].set_exception(e)
+                continue
+            seconds = time.perf_counter() - start
+            with self._cond:
+                self._batch_sizes.append(len(batch))
+                self._batch_seconds.append(seconds)
+                self._queue_seconds.extend(start - queued for _, _, _, queued in batch)
+                self.texts += len(batch)
+                self.batches += 1
+            for (request, i, _, _), vector in zip(batch, vectors):
+                request["vectors"][i] = vector
+                request["remaining"] -= 1
+                if request["remaining"] == 0 and not request["future"].done():
+                    request["future"].set_result(np.asarray(request["vectors"], dtype=np.float32))
+
+    def stats(self):
+        with self._cond:
+            sizes, seconds, waits = list(self._batch_sizes), list(self._batch_seconds), list(self._queue_seconds)
+            stats = {"queue_depth": len(self._pending), "texts": self.texts, "batches": self.batches}
+        if sizes:
+            stats.update(mean_batch_size=round(float(np.mean(sizes)), 2), max_batch_size=max(sizes),
+                         batch_p50_ms=round(float(np.percentile(seconds, 50)) * 1000, 2),
+                         batch_p99_ms=round(float(np.percentile(seconds, 99)) * 1000, 2),
+                         queue_wait_p50_ms=round(float(np.percentile(waits, 50)) * 1000, 2),
+                         queue_wait_p99_ms=round(float(np.percentile(waits, 99)) * 1000, 2))
+        return stats
+
+
+class EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (ConnectionError, struct.error):
+                return
+            op = request.get("op")
+            try:
+                if op == "embed":
+                    vectors = server.batcher.submit(request["texts"]).result()
+                    send_frame(self.request, {"count": len(vectors), "dim": server.dim},
+                               np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                elif op == "info":
+                    send_frame(self.request, {"model_name": server.model_name, "dim": server.dim})
+                elif op == "stats":
+                    send_frame(self.request, server.batcher.stats())
+                else:
+                    send_frame(self.request, {"error": f"Unknown op {op!r}"})
+            except Exception as e:
+                send_frame(self.request, {"error": f"{type(e).__name__}: {e}"})
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, embeddings, **batcher_kwargs):
+        self.socket_path = Path(socket_path)
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self.socket_path.unlink(missing_ok=True)
+        super().__init__(str(self.socket_path), EmbeddingRequestHandler)
+        os.chmod(self.socket_path, 0o600)
+        self.model_name = getattr(embeddings, "model_name", None) or type(embeddings).__name__
+        self.dim = len(embeddings.embed_query("warm-up"))
+        self.batcher = DynamicBatcher(embeddings, **batcher_kwargs)
+
+
+class EmbeddingServiceClient(Embeddings):
+    """LangChain Embeddings backed by the embedding service; safe to share between threads.
+
+    `model_name` is the served model's, so caches keyed by it (see
+    embedding_cache) stay compatible with the in-process model.
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, timeout=300):
+        self.socket_path = str(socket_path)
+        self.timeout = timeout
+        self._local = threading.local()
+        info = self._call({"op": "info"})
+        self.model_name = info["model_name"]
+        self.dim = info["dim"]
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as e:
+                sock.close()
+                raise ConnectionError(f"Embedding service not reachable at {self.socket_path}: {e}. "
+                                      f"Start it with `python embedding_service.py`.") from e
+            self._local.sock = sock
+        return sock
+
+    def _call(self, request):
+        for attempt in range(2):
+            sock = self._connection()
+            try:
+                send_frame(sock, request)
+                response = recv_frame(sock)
+                if "error" in response:
+                    raise RuntimeError(f"Embedding service error: {response['error']}")
+                if request["op"] == "embed":
+                    payload = recv_exactly(sock, response["count"] * response["dim"] * 4)
+                    return np.frombuffer(payload, dtype=np.float32).reshape(response["count"], response["dim"])
+                return response
+            except socket.timeout:
+                # The service may still be working on the request, so sending it again would embed
+                # the batch twice; the connection is dropped since a late response would be misread
+                sock.close()
+                self._local.sock = None
+                raise
+            except (ConnectionError, OSError):
+                # The service may have restarted; reconnect once
+                sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return self._call({"op": "embed", "texts": list(texts)}).tolist()
+
+    def embed_query(self, text):
+        return self._call({"op": "embed", "texts": [text]})[0].tolist()
+
+    def stats(self):
+        return self._call({"op": "stats"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=str(SOCKET_PATH), help="Unix socket to listen on")
+    parser.add_argument("--backend", default=None, help="Embedding backend (default: RAGBOT_EMBEDDING_BACKEND)")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--stats-every", type=float, default=60, help="Seconds between metrics log lines")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    from models import EMBEDDING_BACKEND, load_embedding_model
+
+    embeddings = load_embedding_model(args.backend or EMBEDDING_BACKEND)
+    server = EmbeddingServer(args.socket, embeddings, max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms)
+
+    def log_stats():
+        while True:
+            time.sleep(args.stats_every)
+            logger.info(f"Embedding service: {server.batcher.stats()}")
+
+    threading.Thread(target=log_stats, daemon=True).start()
+    logger.info(f"Serving {server.model_name} ({server.dim} dims) on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.socket_path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# hybrid_search.py
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Constant of reciprocal rank fusion: score = sum of 1 / (RRF_K + rank)
+RRF_K = 60
+# Candidates taken from each of the dense and lexical rankings before fusion
+FETCH_K = int(os.getenv("RAGBOT_HYBRID_FETCH_K", "20"))
+MAX_QUERY_TERMS = 64
+# Identifier-like terms (clause 4.2.1, ERR-1042, BRK.B) are kept whole so they match as phrases
+TERM_PATTERN = re.compile(r"\w(?:[\w.\-/:]*\w)?")
+
+_lexical_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical-search")
+
+
+def fts_query(text):
+    """FTS5 query matching chunks that contain any term of `text`, or None if it has no terms."""
+    terms = list(dict.fromkeys(TERM_PATTERN.findall(text)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    # Quoted, so FTS5 operators in the question are taken literally
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Merge ranked lists of Documents by reciprocal rank, identifying chunks by id.
+
+    Returns (Document, score) pairs, best first.
+    """
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document.id or document.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(key, document)
+    return [(documents[key], score) for key, score in sorted(scores.items(), key=lambda item: -item[1])]
+
+
+def lexical_search(vector_db, query, fetch_k):
+    """BM25 ranking of the chunks, or None if the DB has no full-text index or the query no terms."""
+    docstore = vector_db.docstore
+    match = fts_query(query)
+    if match is None or not getattr(docstore, "has_lexical_index", False):
+        return None
+    return [document for document, _ in docstore.lexical_search(match, fetch_k)]
+
+
+def stored_vectors(index, positions):
+    """Vectors at `positions` as kept by `index` (full precision when it re-scores), or None if it cannot return them."""
+    vectors = getattr(index, "vectors", None)
+    if vectors is not None:
+        return np.asarray(vectors[np.asarray(positions)])
+    try:
+        return np.vstack([index.reconstruct(int(position)) for position in positions])
+    except RuntimeError:
+        # IVF indexes only reconstruct vectors with a direct map
+        return None
+
+
+def dense_similarities(vector_db, embedding, dense, documents):
+    """Similarity 1 / (1 + L2 distance) of each of `documents` to the query, keyed like reciprocal_rank_fusion.
+
+    `dense` are the (Document, distance) pairs of the dense search. Chunks
+    found only by BM25 are scored against their vectors in the index; if it
+    cannot return them they get the similarity of the last dense result.
+    """
+    similarities = {document.id or document.page_content: 1 / (1 + float(distance)) for document, distance in dense}
+    missing = [key for key in (document.id or document.page_content for document in documents)
+               if key not in similarities]
+    if not missing:
+        return similarities
+    floor = min(similarities.values(), default=0.0)
+    positions = vector_db.docstore.positions(missing)
+    ids = [id_ for id_ in missing if id_ in positions]
+    vectors = stored_vectors(vector_db.index, [positions[id_] for id_ in ids]) if ids else None
+    if vectors is not None:
+        distances = ((vectors - np.asarray(embedding, dtype=np.float32)) ** 2).sum(axis=1)
+        similarities.update((id_, 1 / (1 + float(distance))) for id_, distance in zip(ids, distances))
+    return {**{id_: floor for id_ in missing}, **similarities}
+
+
+def hybrid_search(vector_db, query, k=5, fetch_k=FETCH_K, embedding=None):
+    """Run BM25 and dense search concurrently and fuse them with RRF.
+
+    Returns the top `k` (Document, score) pairs in fused order and the
+    latency of each stage in ms ("lexical", "embed", "dense", "fusion",
+    "total"). The score is the dense similarity of the chunk to the query
+    (see dense_similarities), not its fused rank, so that results can be
+    merged across DBs by relevance. `embedding` skips embedding the query
+    again when it is searched in several DBs. DBs without a full-text index
+    fall back to dense results only.
+    """
+    start = time.perf_counter()
+    fetch_k = max(fetch_k, k)
+    timings = {}
+
+    def timed_lexical():
+        lexical_start = time.perf_counter()
+        try:
+            return lexical_search(vector_db, query, fetch_k)
+        finally:
+            timings["lexical"] = (time.perf_counter() - lexical_start) * 1000
+
+    lexical_future = _lexical_pool.submit(timed_lexical)
+    if embedding is None:
+        stage_start = time.perf_counter()
+        embedding = vector_db.embedding_function.embed_query(query)
+        timings["embed"] = (time.perf_counter() - stage_start) * 1000
+    stage_start = time.perf_counter()
+    dense = vector_db.similarity_search_with_score_by_vector(embedding, k=fetch_k)
+    timings["dense"] = (time.perf_counter() - stage_start) * 1000
+    try:
+        lexical = lexical_future.result()
+    except Exception:
+        # Dense results are still useful if the full-text query fails
+        logger.exception("Lexical search failed")
+        lexical = None
+
+    stage_start = time.perf_counter()
+    rankings = [ranking for ranking in [[document for document, _ in dense], lexical] if ranking is not None]
+    fused = [document for document, _ in reciprocal_rank_fusion(rankings)[:k]]
+    similarities = dense_similarities(vector_db, embedding, dense, fused)
+    fused = [(document, similarities[document.id or document.page_content]) for document in fused]
+    timings["fusion"] = (time.perf_counter() - stage_start) * 1000
+    timings["total"] = (time.perf_counter() - start) * 1000
+    logger.debug("Hybrid search: " + ", ".join(f"{stage} {ms:.1f} ms" for stage, ms in timings.items()))
+    return fused, timings
+
+
+def format_timings(timings):
+    stages = ", ".join(f"{stage} {timings[stage]:.0f} ms"
+                       for stage in ["condense", "lexical", "embed", "dense", "fusion", "total", "rerank",
+                                     "packing", "end_to_end", "saved"] if stage in timings)
+    if "speculative" in timings:
+        # How speculative retrieval handled the question (see speculative_retrieval)
+        stages = f"{timings['speculative']}: {stages}"
+    per_db = timings.get("per_db", {})
+    if len(per_db) < 2:
+        return stages
+    return stages + " | " + ", ".join(f"{db_name} {ms:.0f} ms" for db_name, ms in per_db.items())
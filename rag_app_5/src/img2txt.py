@@ -3,7 +3,6 @@
 import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain, create_history_aware_retriever
 from dotenv import load_dotenv
@@ -12,6 +11,10 @@ from pathlib import Path
 
 from config import ModelProvider, VisionModelProvider
 from models import setup_anthropic_vision_model, setup_openai_vision_model, setup_ollama_vision_model
+from chat_history import HISTORY_TOKEN_BUDGET, SummarizingChatHistory
+from hybrid_search import format_timings
+from streaming import GenerationStats, stream_answer
+from dedup import chunk_sources
 from vector_store import VectorStore
 import logging
 import base64
@@ -25,11 +28,12 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 class RAGImageAppTemplate:
-    def __init__(self, personality, prompt_name, prompt_name_rag):
+    def __init__(self, personality, prompt_name, prompt_name_rag, history_token_budget=HISTORY_TOKEN_BUDGET):
         self.vStore = VectorStore()
         self.personality = personality
         self.prompt_name = prompt_name
         self.prompt_name_rag = prompt_name_rag
+        self.history_token_budget = history_token_budget
         self.initialize_session_state()
 
     def initialize_session_state(self):
@@ -70,17 +74,20 @@ class RAGImageAppTemplate:
             if st.session_state[f"use_vector_db_{self.personality}"]:
                 available_vector_dbs = self.vStore.get_available_vector_dbs()
                 if available_vector_dbs:
-                    selected_vector = st.selectbox(
-                        'Choose Vector DB:',
+                    selected_vector = st.multiselect(
+                        'Choose Vector DBs:',
                         available_vector_dbs,
-                        index=0,
+                        default=available_vector_dbs[:1],
+                        help="Selected DBs are searched in parallel and their results merged.",
                     )
-                    # Update the selected vector store if it has changed
-                    if selected_vector != st.session_state[f"selected_vector_{self.personality}"]:
+                    if not selected_vector:
+                        st.warning('Select at least one Vector DB.')
+                    # Update the selected vector stores if they have changed
+                    elif selected_vector != st.session_state[f"selected_vector_{self.personality}"]:
                         st.session_state[f"selected_vector_{self.personality}"] = selected_vector
                         self.vStore.load_vector_store(selected_vector)
-                        st.session_state.current_vector_db = selected_vector  # Track current vector DB
-                        st.success(f"Vector DB updated to: {selected_vector}")  # Feedback to user
+                        st.session_state.current_vector_db = selected_vector  # Track current vector DBs
+                        st.success(f"Vector DB updated to: {', '.join(selected_vector)}")  # Feedback to user
                         st.rerun()  # Rerun the script to reflect changes
                 else:
                     st.warning('No Vector DB available. Please create a new one.')
@@ -182,9 +189,15 @@ class RAGImageAppTemplate:
 
     def get_session_history(self,session_id: str):
         if session_id not in st.session_state[f"rag_{self.personality}_store"]:
-            st.session_state[f"rag_{self.personality}_store"][session_id] = ChatMessageHistory()
+            st.session_state[f"rag_{self.personality}_store"][session_id] = SummarizingChatHistory(self.history_token_budget)
         return st.session_state[f"rag_{self.personality}_store"][session_id]
 
+    def configure_history(self, llm):
+        """Point the session's history at the current model (for summaries) and the personality's budget."""
+        history = self.get_session_history(st.session_state[f"rag_{self.personality}_config"]["configurable"]["session_id"])
+        history.llm = llm
+        history.token_budget = self.history_token_budget
+
     def setup_chain(self, llm, retriever):
         # Include image description in context if available
         image_context = f"\nRelevant Image Context: {st.session_state[f'image_description_{self.personality}']}" if st.session_state[f"image_description_{self.personality}"] else ""
@@ -247,26 +260,42 @@ class RAGImageAppTemplate:
                 st.markdown(prompt)
 
             with st.chat_message("assistant"):
+                stats = GenerationStats()
                 try:
                     if st.session_state[f"use_vector_db_{self.personality}"] : 
-                        with st.spinner("Thinking🤔"):
-                            response = conversational_chain.invoke({"input": prompt}, config=st.session_state[f"rag_{self.personality}_config"])
-                            context_list = list(set(context.metadata['source'] for context in response['context']))
-                            answer = f"{response['answer']}\n\n📌 Source: {', '.join(context_list)}"
-                            response = st.write(answer)
+                        sources = st.empty()
+                        sources.caption("Thinking🤔")
+                        retrieved = {}
+
+                        def show_sources(context):
+                            # Shown as soon as retrieval is done, while the answer is generated
+                            retrieved["context_list"] = list(dict.fromkeys(f"{document.metadata['db']}: {source}" if 'db' in document.metadata else source
+                                                                           for document in context
+                                                                           for source in chunk_sources(document.metadata)))
+                            retrieved["timings"] = next((document.metadata.get("retrieval_ms") for document in context), None)
+                            sources.caption(f"📌 Source: {', '.join(retrieved['context_list'])}")
+
+                        stream = conversational_chain.stream({"input": prompt}, config=st.session_state[f"rag_{self.personality}_config"])
+                        st.write_stream(stream_answer(stream, stats, on_context=show_sources))
+                        answer = f"{stats.text}\n\n📌 Source: {', '.join(retrieved.get('context_list', []))}"
+                        if retrieved.get("timings"):
+                            st.caption(f"Retrieval: {format_timings(retrieved['timings'])}")
                     else:
-                        # When not using vector DB, response is an AIMessage
+                        # When not using vector DB, the stream yields AIMessageChunks
                         stream = conversational_chain.stream({"input": prompt}, config=st.session_state[f"rag_{self.personality}_config"])
-                        response = st.write_stream(stream)
+                        response = st.write_stream(stream_answer(stream, stats))
+                    st.caption(f"Generation: {stats.format()}")
                 except Exception as e:
                     st.info(f"An error occurred: {str(e)}. Please check your API key or try again.")
                     st.stop()
-            st.session_state[f"rag_{self.personality}_messages"].append({"role": "assistant", "content": answer if st.session_state[f"use_vector_db_{self.personality}"] else response})
+            st.session_state[f"rag_{self.personality}_messages"].append({"role": "assistant", "content": answer if st.session_state[f"use_vector_db_{self.personality}"] else response,
+                                                                        "generation": stats.as_dict()})
 
 
     def run(self, welcome_string):
         st.markdown(welcome_string)
         llm, retriever = self.setup_sidebar()
+        self.configure_history(llm)
         self.process_image_section(llm)
         conversational_chain = self.setup_chain(llm, retriever)
         self.clear_chat()
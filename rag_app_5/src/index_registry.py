@@ -0,0 +1,171 @@
+# index_registry.py
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from langchain_community.vectorstores import FAISS
+
+from vector_db_storage import INDEX_FILE, load_vector_db, migrate_if_legacy
+from vector_db_versions import current_version, version_signature
+
+logger = logging.getLogger(__name__)
+
+INDEX_CACHE_MB = int(os.getenv("RAGBOT_INDEX_CACHE_MB", "4096"))
+
+
+@dataclass
+class IndexEntry:
+    vector_db: FAISS
+    size: int
+    refs: int = 0
+    # Set once a newer version of the same DB is loaded
+    stale: bool = False
+
+
+def index_size(path):
+    """Approximate memory footprint of a loaded DB: its index file.
+
+    Chunks and full-precision vectors stay on disk and are only paged in
+    for the hits of a query.
+    """
+    return (Path(path) / INDEX_FILE).stat().st_size
+
+
+class IndexRegistry:
+    """Process-wide cache of loaded vector DBs, shared read-only by every session.
+
+    Indexes are keyed by (DB name, version). `acquire(db_name)` resolves the
+    live version with a stat of the version pointer and pins the index while
+    it is used. When a resync publishes a new version, queries keep using the
+    loaded one while the new one loads in the background; the old version is
+    dropped once nothing holds it. Unpinned indexes are evicted least
+    recently used first when the total size exceeds `budget_mb`, except for
+    the one used last, even if it alone is over budget. DBs still in
+    the pickle format are migrated when they are first resolved.
+    """
+
+    def __init__(self, root, embeddings, budget_mb=INDEX_CACHE_MB):
+        self.root = Path(root)
+        self.embeddings = embeddings
+        self.budget = budget_mb * 2**20
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._loading = set()
+        self._cond = threading.Condition()
+        self._loader = ThreadPoolExecutor(max_workers=2, thread_name_prefix="index-load")
+
+    def _resolve(self, db_name):
+        """Return (version, path) of the DB's live version, re-reading the pointer only when its stat changes."""
+        db_path = self.root / db_name
+        signature = version_signature(db_path)
+        cached = self._versions.get(db_name)
+        if cached and cached[0] == signature:
+            return cached[1], cached[2]
+        if migrate_if_legacy(db_path):
+            # A DB from before versioning is now published as a version
+            signature = version_signature(db_path)
+        version, path = current_version(db_path)
+        if version is None:
+            raise FileNotFoundError(f"Vector database '{db_name}' does not exist.")
+        self._versions[db_name] = (signature, version, path)
+        return version, path
+
+    def live_version(self, db_name):
+        """Name of the published version of `db_name`, as the next acquire would resolve it."""
+        return self._resolve(db_name)[0]
+
+    @contextmanager
+    def acquire(self, db_name):
+        """Pin the live index of `db_name` for the duration of the block."""
+        key, entry = self._checkout(db_name)
+        try:
+            yield entry.vector_db
+        finally:
+            self._release(key, entry)
+
+    def _checkout(self, db_name):
+        version, path = self._resolve(db_name)
+        key = (db_name, version)
+        with self._cond:
+            while True:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return key, self._pin(key, entry)
+                loaded = [(k, e) for k, e in self._entries.items() if k[0] == db_name and not e.stale]
+                if loaded:
+                    # Serve the version already in memory while the new one loads
+                    if key not in self._loading:
+                        self._loading.add(key)
+                        self._loader.submit(self._load_in_background, key, path)
+                    return loaded[-1][0], self._pin(*loaded[-1])
+                if key not in self._loading:
+                    self._loading.add(key)
+                    break
+                self._cond.wait()
+        return key, self._load(key, path, refs=1)
+
+    def _pin(self, key, entry):
+        entry.refs += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def _release(self, key, entry):
+        with self._cond:
+            entry.refs -= 1
+            if entry.refs == 0 and entry.stale:
+                self._drop(key)
+            # The index just used is the most recently used one: only older ones make room
+            self._evict(keep=key)
+
+    def _load(self, key, path, refs):
+        try:
+            vector_db = load_vector_db(path, self.embeddings)
+            entry = IndexEntry(vector_db, index_size(path), refs=refs)
+        except BaseException:
+            with self._cond:
+                self._loading.discard(key)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            for other_key, other in list(self._entries.items()):
+                if other_key[0] == key[0]:
+                    other.stale = True
+                    if other.refs == 0:
+                        self._drop(other_key)
+            self._entries[key] = entry
+            self._loading.discard(key)
+            logger.info(f"Loaded {key[0]} {key[1]} ({entry.size / 2**20:.0f} MB)")
+            self._evict(keep=key)
+            self._cond.notify_all()
+        return entry
+
+    def _load_in_background(self, key, path):
+        try:
+            self._load(key, path, refs=0)
+        except Exception:
+            # The loaded version keeps serving; the next query retries
+            logger.exception(f"Failed to load {key[0]} {key[1]}")
+
+    def _drop(self, key):
+        del self._entries[key]
+        logger.info(f"Unloaded {key[0]} {key[1]}")
+
+    def _evict(self, keep=None):
+        total = sum(entry.size for entry in self._entries.values())
+        for key, entry in list(self._entries.items()):
+            if total <= self.budget:
+                break
+            if entry.refs == 0 and key != keep:
+                self._drop(key)
+                total -= entry.size
+
+    def stats(self):
+        with self._cond:
+            return [{"db": db_name, "version": version, "size_mb": entry.size / 2**20,
+                     "refs": entry.refs, "stale": entry.stale}
+                    for (db_name, version), entry in self._entries.items()]
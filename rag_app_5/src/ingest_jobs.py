@@ -0,0 +1,256 @@
+# ingest_jobs.py
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, inspect, text, Boolean, Column, Integer, Float, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from vector_db_builder import ROOT_DIR, VectorDBBuild, BuildReporter, BuildCancelled, BuildError
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = ROOT_DIR/"jobs"
+JOB_WORKERS = int(os.getenv("RAGBOT_INGEST_JOB_WORKERS", "1"))
+CHECKPOINT_EVERY = int(os.getenv("RAGBOT_CHECKPOINT_CHUNKS", "2000"))
+ACTIVE_STATUSES = ("queued", "running", "cancelling")
+
+# SQLAlchemy setup
+Base = declarative_base()
+
+class IngestJob(Base):
+    __tablename__ = 'ingest_jobs'
+
+    id = Column(Integer, primary_key=True)
+    db_name = Column(String(200), nullable=False)
+    action = Column(String(20), nullable=False)
+    threshold_type = Column(String(50), nullable=False)
+    chunk_vectors = Column(String(20), nullable=False)
+    index_type = Column(String(20), nullable=False, default="flat")
+    compression = Column(String(10), nullable=False, default="none")
+    rescore = Column(Boolean, nullable=False, default=False)
+    source_type = Column(String(20), nullable=False)
+    source = Column(String(500), nullable=False)
+    parse_workers = Column(Integer, nullable=False)
+    parse_timeout = Column(Float, nullable=False)
+    status = Column(String(20), nullable=False, default="queued")
+    message = Column(Text, default="")
+    files_done = Column(Integer, default=0)
+    files_total = Column(Integer, default=0)
+    pages = Column(Integer, default=0)
+    chunks = Column(Integer, default=0)
+    embeddings = Column(Integer, default=0)
+    created_at = Column(Float, nullable=False)
+    started_at = Column(Float)
+    updated_at = Column(Float)
+    finished_at = Column(Float)
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATUSES
+
+    def rates(self):
+        """Pages, chunks and embeddings per second since the job (re)started."""
+        if not self.started_at:
+            return 0.0, 0.0, 0.0
+        elapsed = max(1e-6, (self.finished_at or time.time()) - self.started_at)
+        return self.pages / elapsed, self.chunks / elapsed, self.embeddings / elapsed
+
+engine = create_engine(f"sqlite:///{ROOT_DIR/'jobs.db'}", connect_args={"check_same_thread": False})
+Base.metadata.create_all(engine)
+
+def add_missing_columns():
+    """create_all() does not alter existing tables, so columns added since a jobs.db was created are added here."""
+    existing = {column["name"] for column in inspect(engine).get_columns(IngestJob.__tablename__)}
+    with engine.begin() as connection:
+        for column in IngestJob.__table__.columns:
+            if column.name not in existing:
+                default = column.default.arg if column.default is not None else None
+                default = (f" DEFAULT '{default}'" if isinstance(default, str)
+                           else f" DEFAULT {int(default)}" if default is not None else "")
+                connection.execute(text(f"ALTER TABLE {IngestJob.__tablename__} ADD COLUMN {column.name} "
+                                        f"{column.type.compile(engine.dialect)}{default}"))
+
+add_missing_columns()
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+def update_job(job_id, statuses=None, **values):
+    """Update a job, only if its status is one of `statuses` when given; returns whether it was updated."""
+    session = Session()
+    query = session.query(IngestJob).filter(IngestJob.id == job_id)
+    if statuses is not None:
+        query = query.filter(IngestJob.status.in_(statuses))
+    updated = query.update({**values, "updated_at": time.time()}, synchronize_session=False)
+    session.commit()
+    session.close()
+    return updated > 0
+
+def load_jobs(limit=20):
+    session = Session()
+    jobs = session.query(IngestJob).order_by(IngestJob.id.desc()).limit(limit).all()
+    session.close()
+    return jobs
+
+def aws_config_from_env():
+    """AWS settings for jobs resumed after a restart, when the UI-provided ones are gone."""
+    aws_config = {
+        'region_name': os.getenv('AWS_REGION_NAME'),
+        'aws_access_key_id': os.getenv('AWS_ACCESS_KEY'),
+        'aws_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
+    }
+    return {key: value for key, value in aws_config.items() if value}
+
+
+class JobReporter(BuildReporter):
+    """Writes build progress to the job table, at most once per second for batches."""
+
+    def __init__(self, job_id, cancel_event):
+        self.job_id = job_id
+        self.cancel_event = cancel_event
+        self.pages = 0
+        self.stats = None
+        self.last_write = 0.0
+
+    def message(self, text):
+        logger.info(f"Job {self.job_id}: {text}")
+        update_job(self.job_id, message=text)
+
+    def parsed(self, result, done, total):
+        self.pages += result.pages
+        update_job(self.job_id, files_done=done, files_total=total, pages=self.pages)
+
+    def batch(self, stats):
+        self.stats = stats
+        now = time.time()
+        if now - self.last_write >= 1.0:
+            self.flush()
+            self.last_write = now
+
+    def flush(self):
+        if self.stats:
+            update_job(self.job_id, chunks=self.stats.chunks, embeddings=self.stats.embeddings)
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class JobRunner:
+    """Runs vector DB builds on background threads, tracked in the `ingest_jobs` table.
+
+    Jobs outlive the Streamlit script run that submitted them. Each job
+    checkpoints into ~/.ragbot/jobs/<id>; jobs left queued or running by a
+    crashed process are resumed from their checkpoint when the runner starts.
+    """
+
+    def __init__(self, embedding_model_factory, workers=JOB_WORKERS):
+        self.embedding_model_factory = embedding_model_factory
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-job")
+        self.cancel_events = {}
+        self.aws_configs = {}
+        self.lock = threading.Lock()
+        self.resume_interrupted()
+
+    def active_job(self, db_name):
+        session = Session()
+        job = (session.query(IngestJob)
+               .filter(IngestJob.db_name == db_name, IngestJob.status.in_(ACTIVE_STATUSES))
+               .first())
+        session.close()
+        return job
+
+    def submit(self, db_name, action, threshold_type, source_type, source, chunk_vectors,
+               parse_workers, parse_timeout, aws_config=None, index_type="flat", compression="none",
+               rescore=False):
+        """Queue a build. Returns (job, True), or (existing job, False) if `db_name` is already being built."""
+        with self.lock:
+            existing = self.active_job(db_name)
+            if existing:
+                return existing, False
+            session = Session()
+            job = IngestJob(db_name=db_name, action=action, threshold_type=threshold_type,
+                            chunk_vectors=chunk_vectors, index_type=index_type,
+                            compression=compression, rescore=rescore,
+                            source_type=source_type, source=source,
+                            parse_workers=parse_workers, parse_timeout=parse_timeout,
+                            status="queued", created_at=time.time())
+            session.add(job)
+            session.commit()
+            session.close()
+        self.aws_configs[job.id] = aws_config
+        self._schedule(job.id)
+        return job, True
+
+    def cancel(self, job_id):
+        # A job that already finished or failed stays as it is rather than being stuck "cancelling"
+        if not update_job(job_id, statuses=ACTIVE_STATUSES, status="cancelling"):
+            return
+        event = self.cancel_events.get(job_id)
+        if event:
+            event.set()
+
+    def resume_interrupted(self):
+        session = Session()
+        jobs = session.query(IngestJob).filter(IngestJob.status.in_(ACTIVE_STATUSES)).all()
+        session.close()
+        for job in jobs:
+            if job.status == "cancelling":
+                update_job(job.id, status="cancelled", finished_at=time.time())
+                continue
+            logger.info(f"Resuming interrupted ingestion job {job.id} for '{job.db_name}'")
+            update_job(job.id, status="queued", message="Resuming after restart...")
+            self._schedule(job.id)
+
+    def _schedule(self, job_id):
+        self.cancel_events[job_id] = threading.Event()
+        self.executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        session = Session()
+        job = session.get(IngestJob, job_id)
+        session.close()
+        if job.status == "cancelling":
+            update_job(job_id, status="cancelled", message="Cancelled before it started.", finished_at=time.time())
+        if job.status != "queued":
+            return
+        update_job(job_id, status="running", started_at=time.time(), finished_at=None,
+                   files_done=0, files_total=0, pages=0, chunks=0, embeddings=0)
+        reporter = JobReporter(job_id, self.cancel_events[job_id])
+        work_dir = JOBS_DIR / str(job_id)
+        try:
+            embedding_model = self.embedding_model_factory()
+            build = VectorDBBuild(job.db_name, job.action, job.threshold_type, job.source_type, job.source,
+                                  embedding_model, work_dir, chunk_vectors=job.chunk_vectors,
+                                  aws_config=self.aws_configs.pop(job_id, None) or aws_config_from_env(),
+                                  reporter=reporter, parse_workers=job.parse_workers,
+                                  parse_timeout=job.parse_timeout, checkpoint_every=CHECKPOINT_EVERY,
+                                  index_type=job.index_type, compression=job.compression,
+                                  rescore=job.rescore)
+            state = build.run()
+            message = f"Vector database '{job.db_name}' {'resynced' if job.action == 'resync' else 'created'} successfully."
+            if state.get("summary"):
+                message += f" ({state['summary']})"
+            if state.get("dedup_report"):
+                message += f" {state['dedup_report']}."
+            if state.get("index_report"):
+                message += f" {state['index_report']}."
+            if hasattr(embedding_model, "cache"):
+                cache_stats = embedding_model.cache.stats()
+                message += (f" Embedding cache: {cache_stats['hit_rate']:.0%} hit rate, "
+                            f"{cache_stats['entries']} entries / {cache_stats['size_mb']:.0f} MB.")
+            reporter.flush()
+            update_job(job_id, status="completed", message=message, finished_at=time.time())
+        except BuildCancelled:
+            update_job(job_id, status="cancelled", message="Cancelled.", finished_at=time.time())
+        except BuildError as e:
+            update_job(job_id, status="failed", message=str(e), finished_at=time.time())
+        except Exception as e:
+            logger.exception(f"Ingestion job {job_id} failed")
+            update_job(job_id, status="failed", message=f"{type(e).__name__}: {e}", finished_at=time.time())
+        finally:
+            # Checkpoints are only kept for jobs interrupted by a crash
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self.cancel_events.pop(job_id, None)
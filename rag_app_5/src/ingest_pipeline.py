@@ -0,0 +1,146 @@
+# ingest_pipeline.py
+import logging
+import os
+import uuid
+from dataclasses import dataclass, field
+from itertools import islice
+
+from langchain_community.vectorstores import FAISS
+
+from dedup import add_chunk_source
+
+logger = logging.getLogger(__name__)
+
+# Number of chunks embedded and added to the index per step.
+EMBED_BATCH_SIZE = int(os.getenv("RAGBOT_EMBED_BATCH_SIZE", "64"))
+
+
+@dataclass
+class IngestStats:
+    documents: int = 0
+    chunks: int = 0
+    embeddings: int = 0
+    duplicates: int = 0
+    ids_by_source: dict = field(default_factory=dict)
+    # Surviving chunk id -> sources of its near-duplicates, until they are recorded on the chunk
+    merged_sources: dict = field(default_factory=dict)
+
+    @property
+    def dedup_ratio(self):
+        return self.duplicates / self.chunks if self.chunks else 0.0
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def count_documents(documents, stats):
+    for document in documents:
+        stats.documents += 1
+        stats.ids_by_source.setdefault(document.metadata["source"], [])
+        yield document
+
+
+def assign_id(chunk, stats, dedup=None):
+    """Give a chunk a stable id and record it under its source.
+
+    With a NearDuplicateIndex, a near-duplicate of an earlier chunk is
+    recorded under the earlier chunk's id instead and None is returned, so
+    it is neither embedded nor indexed.
+    """
+    source = chunk.metadata["source"]
+    stats.chunks += 1
+    if dedup is not None:
+        signature = dedup.hasher.signature(chunk.page_content)
+        survivor = dedup.find(signature)
+        if survivor is not None:
+            stats.duplicates += 1
+            stats.ids_by_source[source].append(survivor)
+            stats.merged_sources.setdefault(survivor, []).append(source)
+            return None
+    chunk.id = str(uuid.uuid4())
+    if dedup is not None:
+        dedup.add(chunk.id, signature)
+    stats.ids_by_source[source].append(chunk.id)
+    return chunk
+
+
+def iter_chunks(documents, text_splitter, stats, dedup=None):
+    """Split documents one at a time."""
+    for document in count_documents(documents, stats):
+        for chunk in text_splitter.split_documents([document]):
+            if assign_id(chunk, stats, dedup) is not None:
+                yield chunk
+
+
+def iter_embedded_batches(chunks, embedding_model, batch_size=EMBED_BATCH_SIZE):
+    for batch in batched(chunks, batch_size):
+        vectors = embedding_model.embed_documents([chunk.page_content for chunk in batch])
+        yield batch, vectors
+
+
+def iter_chunk_vector_batches(documents, chunker, stats, batch_size=EMBED_BATCH_SIZE, dedup=None):
+    """Batches from a chunker that already produced the chunk vectors (see SentenceEmbeddingChunker)."""
+    pairs = chunker.iter_chunks_with_vectors(count_documents(documents, stats))
+    unique = ((chunk, vector) for chunk, vector in pairs if assign_id(chunk, stats, dedup) is not None)
+    for batch in batched(unique, batch_size):
+        yield [chunk for chunk, _ in batch], [vector for _, vector in batch]
+
+
+def add_batch(vector_db, chunks, vectors, embedding_model):
+    text_embeddings = [(chunk.page_content, vector) for chunk, vector in zip(chunks, vectors)]
+    metadatas = [chunk.metadata for chunk in chunks]
+    ids = [chunk.id for chunk in chunks]
+    if vector_db is None:
+        return FAISS.from_embeddings(text_embeddings, embedding_model, metadatas=metadatas, ids=ids)
+    vector_db.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+    return vector_db
+
+
+def record_merged_sources(vector_db, stats):
+    """List the sources of near-duplicates on their surviving chunks once those are in the docstore."""
+    for survivor, sources in list(stats.merged_sources.items()):
+        document = vector_db.docstore.search(survivor)
+        if isinstance(document, str):
+            # Not indexed yet
+            continue
+        for source in sources:
+            add_chunk_source(document.metadata, source)
+        del stats.merged_sources[survivor]
+
+
+def run_pipeline(documents, text_splitter, embedding_model, vector_db=None,
+                 batch_size=EMBED_BATCH_SIZE, on_batch=None, dedup=None):
+    """Stream documents through parse -> chunk -> dedup -> embed -> index.
+
+    Every stage is a generator pulling from the previous one, so only the
+    documents behind the current micro-batch of `batch_size` chunks are held in
+    memory and upstream parsing pauses while a batch is being embedded.
+    A splitter that yields chunk vectors itself skips the embedding stage.
+    With `dedup` (a NearDuplicateIndex, which may already hold the chunks of
+    `vector_db`), near-duplicate chunks are dropped before embedding and
+    their sources added to metadata["sources"] of the chunk they duplicate.
+    Chunks are added to `vector_db` (created on the first batch if None) and
+    `on_batch(vector_db, batch, stats)` is called after each batch.
+    Returns the vector DB (None if nothing was chunked) and the IngestStats.
+    """
+    stats = IngestStats()
+    if hasattr(text_splitter, "iter_chunks_with_vectors"):
+        batches = iter_chunk_vector_batches(documents, text_splitter, stats, batch_size, dedup)
+    else:
+        chunks = iter_chunks(documents, text_splitter, stats, dedup)
+        batches = iter_embedded_batches(chunks, embedding_model, batch_size)
+    for batch, vectors in batches:
+        vector_db = add_batch(vector_db, batch, vectors, embedding_model)
+        stats.embeddings += len(batch)
+        record_merged_sources(vector_db, stats)
+        if on_batch:
+            on_batch(vector_db, batch, stats)
+    if vector_db is not None:
+        # Duplicates after the last new chunk only refer to chunks already indexed
+        record_merged_sources(vector_db, stats)
+    logger.info(f"Ingested {stats.chunks} chunks from {stats.documents} documents"
+                + (f", {stats.duplicates} near-duplicates merged" if dedup is not None else ""))
+    return vector_db, stats
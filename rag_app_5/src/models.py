@@ -1,16 +1,24 @@
 # models.py
+# Provider SDKs and the embedding backend are imported inside the functions
+# using them, so a page only pays for the provider that is selected. Chat
+# clients are shared through the chain registry, so reruns and sessions with
+# the same model and key reuse one client and its connection pool.
+from __future__ import annotations
 import os
-from typing import Any
+from typing import TYPE_CHECKING
 import streamlit as st
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_groq import ChatGroq
-from langchain_mistralai import ChatMistralAI
-from langchain_ollama import ChatOllama
 from config import OPENAI_MODELS, ANTHROPIC_MODELS, GROQ_MODELS, MISTRAL_MODELS, OLLAMA_MODELS, OPENAI_VISION_MODELS, ANTHROPIC_VISION_MODELS, OLLAMA_VISION_MODELS
-from langchain_huggingface import HuggingFaceEmbeddings
+from embedding_cache import CachedEmbeddings, LRUQueryEmbeddings
+from chain_registry import get_chain_registry
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from langchain_anthropic import ChatAnthropic
+    from langchain_groq import ChatGroq
+    from langchain_mistralai import ChatMistralAI
+    from langchain_ollama import ChatOllama
+
 load_dotenv()
 
 def setup_openai_model() -> ChatOpenAI:
@@ -25,7 +33,9 @@ def setup_openai_model() -> ChatOpenAI:
             st.stop()
 
     try:
-        return ChatOpenAI(
+        from langchain_openai import ChatOpenAI
+        return get_chain_registry().client(
+            ChatOpenAI,
             model=st.session_state.selected_model,
             temperature=0.2,
             max_tokens=4096,
@@ -49,7 +59,9 @@ def setup_openai_vision_model() -> ChatOpenAI:
             st.stop()
 
     try:
-        return ChatOpenAI(
+        from langchain_openai import ChatOpenAI
+        return get_chain_registry().client(
+            ChatOpenAI,
             model=st.session_state.selected_model,
             temperature=0,
             max_tokens=4096,
@@ -73,7 +85,9 @@ def setup_anthropic_model() -> ChatAnthropic:
             st.stop()
 
     try:
-        return ChatAnthropic(
+        from langchain_anthropic import ChatAnthropic
+        return get_chain_registry().client(
+            ChatAnthropic,
             model=st.session_state.selected_model,
             temperature=0.2,
             max_tokens=4096,
@@ -99,7 +113,9 @@ def setup_anthropic_vision_model() -> ChatAnthropic:
             st.stop()
 
     try:
-        return ChatAnthropic(
+        from langchain_anthropic import ChatAnthropic
+        return get_chain_registry().client(
+            ChatAnthropic,
             model=st.session_state.selected_model,
             temperature=0,
             max_tokens=4096,
@@ -125,7 +141,9 @@ def setup_groq_model() -> ChatGroq:
             st.stop()
 
     try:
-        return ChatGroq(
+        from langchain_groq import ChatGroq
+        return get_chain_registry().client(
+            ChatGroq,
             model=st.session_state.selected_model,
             temperature=0.7,
             max_tokens=4096,
@@ -149,7 +167,9 @@ def setup_mistral_model() -> ChatMistralAI:
             st.stop()
 
     try:
-        return ChatMistralAI(
+        from langchain_mistralai import ChatMistralAI
+        return get_chain_registry().client(
+            ChatMistralAI,
             model=st.session_state.selected_model,
             temperature=0.7,
             max_tokens=4096,
@@ -168,7 +188,9 @@ def setup_ollama_model() -> ChatOllama:
     selected_model = st.sidebar.selectbox("Choose model:", model_options, index=0)
     st.session_state.selected_model = OLLAMA_MODELS[selected_model]
     try:
-        return ChatOllama(
+        from langchain_ollama import ChatOllama
+        return get_chain_registry().client(
+            ChatOllama,
             model=st.session_state.selected_model
         )
     except Exception as e:
@@ -181,15 +203,44 @@ def setup_ollama_vision_model() -> ChatOllama:
     selected_model = st.sidebar.selectbox("Choose model:", model_options, index=0)
     st.session_state.selected_model = OLLAMA_VISION_MODELS[selected_model]
     try:
-        return ChatOllama(
+        from langchain_ollama import ChatOllama
+        return get_chain_registry().client(
+            ChatOllama,
             model=st.session_state.selected_model
         )
     except Exception as e:
         st.error(f"Error setting up Ollama model: {str(e)}")
         st.stop()
 
-@st.cache_resource      
-def setup_embedding_model():
+EMBEDDING_MODEL = "BAAI/bge-large-en-v1.5"
+# "torch" (HuggingFaceEmbeddings), "onnx" or "onnx-int8" (see onnx_embeddings)
+EMBEDDING_BACKEND = os.getenv("RAGBOT_EMBEDDING_BACKEND", "torch")
+# Unix socket of a shared embedding service (see embedding_service); empty loads the model in-process
+EMBEDDING_SERVICE = os.getenv("RAGBOT_EMBEDDING_SERVICE", "")
+
+
+def load_embedding_model(backend=EMBEDDING_BACKEND):
+    if backend in ("onnx", "onnx-int8"):
+        from onnx_embeddings import OnnxEmbeddings
+        return OnnxEmbeddings(EMBEDDING_MODEL, quantize=backend == "onnx-int8")
+    from langchain_huggingface import HuggingFaceEmbeddings
     model_kwargs = {'trust_remote_code': True}
     # return HuggingFaceEmbeddings(model_name="BAAI/bge-m3", model_kwargs=model_kwargs)
-    return HuggingFaceEmbeddings(model_name="BAAI/bge-large-en-v1.5", model_kwargs=model_kwargs)
\ No newline at end of file
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, model_kwargs=model_kwargs)
+
+@st.cache_resource      
+def setup_embedding_model():
+    if EMBEDDING_SERVICE:
+        from embedding_service import EmbeddingServiceClient
+        return EmbeddingServiceClient(EMBEDDING_SERVICE)
+    return load_embedding_model()
+
+@st.cache_resource
+def setup_document_embedding_model():
+    """Embedding model for ingestion, backed by the on-disk embedding cache."""
+    return CachedEmbeddings(setup_embedding_model())
+
+@st.cache_resource
+def setup_query_embedding_model():
+    """Embedding model for search queries, with an in-process LRU of recent query embeddings."""
+    return LRUQueryEmbeddings(setup_embedding_model())
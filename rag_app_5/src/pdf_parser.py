@@ -0,0 +1,169 @@
+# pdf_parser.py
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.document_loaders.parsers import PyPDFParser
+from langchain_core.document_loaders import Blob
+
+logger = logging.getLogger(__name__)
+
+PARSE_WORKERS = int(os.getenv("RAGBOT_PARSE_WORKERS", "0")) or os.cpu_count() or 1
+PARSE_TIMEOUT = float(os.getenv("RAGBOT_PARSE_TIMEOUT", "120"))
+# When a worker dies (e.g. a crash inside the parser) every file it took down
+# with it is retried once, alone on the pool, so only the culprit fails.
+MAX_ATTEMPTS = 2
+
+# Workers are never forked from the app process: it runs threads and has torch and FAISS loaded,
+# and a fork can copy locks held by other threads and deadlock. The fork server imports the
+# main module and this one once, then forks workers from that clean process, so they start
+# without importing either again; Windows only has spawn.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context("forkserver")
+    _mp_context.set_forkserver_preload(["__main__", __name__])
+else:
+    _mp_context = multiprocessing.get_context("spawn")
+
+
+@dataclass
+class ParseResult:
+    name: str
+    text: str = None
+    pages: int = 0
+    error: str = None
+    seconds: float = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@dataclass
+class PdfBytes:
+    """A PDF held in memory, e.g. an object body downloaded from S3."""
+    name: str
+    data: bytes
+
+
+def source_name(source):
+    return source.name if isinstance(source, PdfBytes) else Path(source).name
+
+
+def parse_pdf(source):
+    """Extract the text of one PDF, given as a path or PdfBytes. Runs inside a pool worker."""
+    start = time.perf_counter()
+    if isinstance(source, PdfBytes):
+        pages = PyPDFParser().lazy_parse(Blob.from_data(source.data, path=source.name))
+    else:
+        pages = PyPDFLoader(str(source)).lazy_load()
+    pages = [page.page_content for page in pages]
+    return ParseResult(source_name(source), "".join(pages), len(pages), seconds=time.perf_counter() - start)
+
+
+def _kill_workers(executor):
+    # ProcessPoolExecutor has no public way to stop a running task, so a
+    # pathological file is dealt with by killing the pool's processes,
+    # found in its private _processes.
+    processes = getattr(executor, "_processes", None)
+    if processes is None:
+        # Should a Python release drop that attribute, the stuck workers are
+        # only abandoned: they exit once their file is done, while the
+        # parse continues on a new pool.
+        logger.warning("Cannot kill the parser processes, leaving them to finish")
+    for process in list((processes or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_pdfs(sources, workers=PARSE_WORKERS, timeout=PARSE_TIMEOUT, on_progress=None, total=None):
+    """Parse PDFs on a process pool, yielding a ParseResult per file as it finishes.
+
+    `sources` are paths or PdfBytes and may be a lazy iterator (e.g. of
+    downloads): the next source is only pulled once a worker is free.
+    At most `workers` files are in flight, so each one is actually running
+    while its `timeout` counts down. A file that runs past its timeout or
+    keeps crashing its worker is reported as a failed result; the other
+    files in flight are resubmitted on a fresh pool and the run continues.
+    `on_progress(result, done, total)` is called after every file; pass
+    `total` when `sources` has no length.
+    """
+    if total is None and hasattr(sources, "__len__"):
+        total = len(sources)
+    pending = iter(sources)
+    # Sources waiting to be (re)submitted, taken from the end
+    queue = []
+    done = 0
+    workers = max(1, min(workers, total or workers))
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context)
+    in_flight = {}
+
+    def finish(result):
+        nonlocal done
+        done += 1
+        if result.ok:
+            logger.info(f"{result.name} has {result.pages} pages ({result.seconds:.2f}s)")
+        else:
+            logger.warning(f"Failed to parse {result.name}: {result.error}")
+        if on_progress:
+            on_progress(result, done, total)
+        return result
+
+    try:
+        while True:
+            while len(in_flight) < workers:
+                if not queue:
+                    source = next(pending, None)
+                    if source is None:
+                        break
+                    queue.append((source, 1))
+                source, attempt = queue[-1]
+                if in_flight and (attempt > 1 or any(a > 1 for _, a, _ in in_flight.values())):
+                    break
+                queue.pop()
+                future = executor.submit(parse_pdf, source)
+                in_flight[future] = (source, attempt, time.monotonic() + timeout)
+            if not in_flight:
+                break
+
+            next_deadline = min(deadline for _, _, deadline in in_flight.values())
+            finished, _ = wait(in_flight, timeout=max(0.0, next_deadline - time.monotonic()),
+                               return_when=FIRST_COMPLETED)
+
+            broken = False
+            for future in finished:
+                source, attempt, _ = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    if attempt < MAX_ATTEMPTS:
+                        queue.append((source, attempt + 1))
+                        continue
+                    result = ParseResult(source_name(source), error="parser process crashed")
+                except Exception as e:
+                    result = ParseResult(source_name(source), error=str(e))
+                yield finish(result)
+
+            now = time.monotonic()
+            expired = [future for future, (_, _, deadline) in in_flight.items() if deadline <= now and not future.done()]
+            for future in expired:
+                source, _, _ = in_flight.pop(future)
+                yield finish(ParseResult(source_name(source), error=f"timed out after {timeout:.0f}s"))
+
+            if expired or broken:
+                _kill_workers(executor)
+                for source, attempt, _ in in_flight.values():
+                    queue.append((source, attempt))
+                in_flight.clear()
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context)
+    finally:
+        if in_flight:
+            _kill_workers(executor)
+        else:
+            executor.shutdown(wait=True)
@@ -2,6 +2,7 @@ import streamlit as st
 from sqlalchemy import create_engine, Column, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from chat_history import HISTORY_TOKEN_BUDGET, add_history_budget_column
 
 # SQLAlchemy setup
 Base = declarative_base()
@@ -14,8 +15,11 @@ class Personality(Base):
     system_prompt = Column(Text, nullable=False)
     system_prompt_rag = Column(Text, nullable=False)
     personality_title = Column(String(100), nullable=False)
+    # Tokens of chat history sent with each question; NULL uses HISTORY_TOKEN_BUDGET
+    history_token_budget = Column(Integer, nullable=True)
 
 engine = create_engine('sqlite:///personalities.db', echo=True)
+add_history_budget_column(engine)
 Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 
@@ -26,19 +30,20 @@ def load_personalities():
     session.close()
     return personalities
 
-def add_personality(name, prompt, prompt_rag, title):
+def add_personality(name, prompt, prompt_rag, title, history_token_budget=None):
     session = Session()
     new_personality = Personality(
         personality_name=name,
         system_prompt=prompt,
         system_prompt_rag=prompt_rag,
-        personality_title=title
+        personality_title=title,
+        history_token_budget=history_token_budget
     )
     session.add(new_personality)
     session.commit()
     session.close()
 
-def update_personality(id, name, prompt, prompt_rag, title):
+def update_personality(id, name, prompt, prompt_rag, title, history_token_budget=None):
     session = Session()
     personality = session.query(Personality).get(id)
     if personality:
@@ -46,6 +51,7 @@ def update_personality(id, name, prompt, prompt_rag, title):
         personality.system_prompt = prompt
         personality.system_prompt_rag = prompt_rag
         personality.personality_title = title
+        personality.history_token_budget = history_token_budget
         session.commit()
     session.close()
 
@@ -83,8 +89,16 @@ if nav == "Add Personality":
         key="new_prompt_rag"
     )
 
+    new_history_token_budget = st.number_input(
+        "Chat history token budget",
+        min_value=200,
+        value=HISTORY_TOKEN_BUDGET,
+        step=100,
+        help="Tokens of chat history sent with each question; older turns are summarised."
+    )
+
     if st.button('Add Personality'):
-        add_personality(new_name, new_prompt, new_prompt_rag, new_title)
+        add_personality(new_name, new_prompt, new_prompt_rag, new_title, new_history_token_budget)
         st.success('Personality added successfully!')
 
 # Edit Personality Page
@@ -118,10 +132,19 @@ elif nav == "Edit Personality":
             key=f"edit_prompt_rag_{selected_personality.id}"
         )
 
+        edit_history_token_budget = st.number_input(
+            "Chat history token budget",
+            min_value=200,
+            value=selected_personality.history_token_budget or HISTORY_TOKEN_BUDGET,
+            step=100,
+            help="Tokens of chat history sent with each question; older turns are summarised.",
+            key=f"edit_history_token_budget_{selected_personality.id}"
+        )
+
         col1, col2 = st.columns(2)
         with col1:
             if st.button('Save Changes'):
-                update_personality(selected_personality.id, edit_name, edit_prompt, edit_prompt_rag, edit_title)
+                update_personality(selected_personality.id, edit_name, edit_prompt, edit_prompt_rag, edit_title, edit_history_token_budget)
                 st.success('Personality updated successfully!')
         with col2:
             if st.button('Delete Personality'):
@@ -0,0 +1,107 @@
+# reranker.py
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+import streamlit as st
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from embedding_cache import normalize_text
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+RERANK_MODEL = os.getenv("RAGBOT_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Candidates retrieved for the cross-encoder to score
+RERANK_FETCH_K = int(os.getenv("RAGBOT_RERANK_FETCH_K", "50"))
+RERANK_TOP_N = int(os.getenv("RAGBOT_RERANK_TOP_N", "4"))
+# Chunks are passed to the LLM until their text reaches this many tokens
+RERANK_TOKEN_BUDGET = int(os.getenv("RAGBOT_RERANK_TOKEN_BUDGET", "2000"))
+SCORE_CACHE_SIZE = 50_000
+
+
+class CrossEncoderReranker:
+    """Scores (query, chunk) pairs with a cross-encoder on the CPU.
+
+    The uncached pairs of a query are scored in a single forward pass.
+    Scores are cached by (normalised query, chunk id); chunk ids are never
+    reused for different text, so entries stay valid across DB versions.
+    """
+
+    def __init__(self, model_name=RERANK_MODEL, cache_size=SCORE_CACHE_SIZE):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score(self, query, documents):
+        query = normalize_text(query)
+        keys = [(query, document.id or document.page_content) for document in documents]
+        with self._lock:
+            scores = {key: self._cache[key] for key in keys if key in self._cache}
+            for key in scores:
+                self._cache.move_to_end(key)
+        missing = [(key, document) for key, document in zip(keys, documents) if key not in scores]
+        if missing:
+            predicted = self.model.predict([(query, document.page_content) for _, document in missing],
+                                           batch_size=len(missing), show_progress_bar=False)
+            with self._lock:
+                for (key, _), value in zip(missing, predicted):
+                    scores[key] = self._cache[key] = float(value)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [scores[key] for key in keys]
+
+
+@st.cache_resource
+def get_reranker():
+    """One cross-encoder per server process, shared by all sessions."""
+    return CrossEncoderReranker()
+
+
+def select_within_budget(documents, top_n, token_budget):
+    """The first `top_n` documents whose text fits in `token_budget` tokens; the best one is always kept."""
+    selected, used = [], 0
+    for document in documents[:top_n]:
+        tokens = count_tokens(document.page_content)
+        if selected and used + tokens > token_budget:
+            break
+        selected.append(document)
+        used += tokens
+    return selected
+
+
+class RerankingRetriever(BaseRetriever):
+    """Re-orders the over-fetched results of `base_retriever` by cross-encoder score.
+
+    Only the best `top_n` chunks within `token_budget` tokens are returned.
+    The rerank latency in ms is added to metadata["retrieval_ms"] and each
+    chunk's score to metadata["rerank_score"].
+    """
+
+    base_retriever: BaseRetriever
+    reranker: Any
+    top_n: int = RERANK_TOP_N
+    token_budget: int = RERANK_TOKEN_BUDGET
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        documents = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if not documents:
+            return documents
+        start = time.perf_counter()
+        scores = self.reranker.score(query, documents)
+        ranked = [document for _, document in sorted(zip(scores, documents), key=lambda pair: -pair[0])]
+        for score, document in zip(scores, documents):
+            document.metadata["rerank_score"] = score
+        selected = select_within_budget(ranked, self.top_n, self.token_budget)
+        timings = {**documents[0].metadata.get("retrieval_ms", {}), "rerank": (time.perf_counter() - start) * 1000}
+        for document in selected:
+            document.metadata["retrieval_ms"] = timings
+        logger.debug(f"Reranked {len(documents)} chunks to {len(selected)} in {timings['rerank']:.0f} ms")
+        return selected
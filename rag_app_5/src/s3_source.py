@@ -0,0 +1,96 @@
+# s3_source.py
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+import boto3
+from botocore.config import Config
+
+from pdf_parser import PdfBytes
+
+logger = logging.getLogger(__name__)
+
+# Concurrent downloads, which is also the size of the client's connection pool.
+S3_WORKERS = int(os.getenv("RAGBOT_S3_WORKERS", "16"))
+LIST_PAGE_SIZE = 1000
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+@dataclass
+class S3Object:
+    key: str
+    etag: str
+    size: int
+
+    def fingerprint(self):
+        return {"size": self.size, "etag": self.etag}
+
+
+def get_s3_client(aws_config=None, max_connections=S3_WORKERS):
+    """Return a process-wide S3 client for these settings.
+
+    boto3 clients are thread safe, so one client per configuration is shared
+    by every build and its connection pool is sized for `max_connections`
+    concurrent downloads. Credentials or an endpoint missing from
+    `aws_config` are resolved by boto3 as usual (AWS_* environment
+    variables, AWS_ENDPOINT_URL for a local stand-in such as moto).
+    """
+    key = (tuple(sorted((aws_config or {}).items())), max_connections)
+    with _clients_lock:
+        if key not in _clients:
+            config = Config(max_pool_connections=max_connections, retries={"max_attempts": 5, "mode": "adaptive"})
+            _clients[key] = boto3.session.Session().client("s3", config=config, **(aws_config or {}))
+        return _clients[key]
+
+
+def list_pdf_objects(client, bucket):
+    """List the PDF objects of a bucket, one page of keys at a time."""
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, PaginationConfig={"PageSize": LIST_PAGE_SIZE}):
+        for item in page.get("Contents", []):
+            if item["Key"].lower().endswith(".pdf"):
+                yield S3Object(item["Key"], item["ETag"].strip('"'), item["Size"])
+
+
+def download_objects(client, bucket, objects, workers=S3_WORKERS, on_error=None):
+    """Download objects concurrently, yielding PdfBytes as each body arrives.
+
+    Only `workers` downloads are in flight and the next one starts when the
+    consumer takes a body, so a slow consumer (the parse pool) bounds how
+    many bodies are held in memory. Failed downloads are passed to
+    `on_error(s3_object, exception)` and skipped.
+    """
+    def download(s3_object):
+        response = client.get_object(Bucket=bucket, Key=s3_object.key, IfMatch=f'"{s3_object.etag}"')
+        return PdfBytes(s3_object.key, response["Body"].read())
+
+    objects = iter(objects)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3-download") as executor:
+        in_flight = {}
+        try:
+            while True:
+                while len(in_flight) < workers:
+                    s3_object = next(objects, None)
+                    if s3_object is None:
+                        break
+                    in_flight[executor.submit(download, s3_object)] = s3_object
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    s3_object = in_flight.pop(future)
+                    try:
+                        body = future.result()
+                    except Exception as e:
+                        logger.warning(f"Failed to download s3://{bucket}/{s3_object.key}: {e}")
+                        if on_error:
+                            on_error(s3_object, e)
+                        continue
+                    yield body
+        finally:
+            for future in in_flight:
+                future.cancel()
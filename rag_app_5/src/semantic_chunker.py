@@ -0,0 +1,134 @@
+# semantic_chunker.py
+import copy
+import re
+
+import numpy as np
+from langchain_core.documents import Document
+
+BREAKPOINT_DEFAULTS = {
+    "percentile": 95,
+    "standard_deviation": 3,
+    "interquartile": 1.5,
+    "gradient": 95,
+}
+# How the vector of a chunk is obtained once its boundaries are known.
+CHUNK_VECTORS_REUSE = "reuse"
+CHUNK_VECTORS_REENCODE = "reencode"
+CHUNK_VECTOR_MODES = [CHUNK_VECTORS_REUSE, CHUNK_VECTORS_REENCODE]
+# Documents are grouped until they hold at least this many sentences, which
+# are then embedded in a single call.
+SENTENCE_BATCH_SIZE = 512
+
+
+def breakpoint_threshold(distances, threshold_type, amount):
+    """Return the threshold and the array it applies to, as SemanticChunker does."""
+    if threshold_type == "percentile":
+        return np.percentile(distances, amount), distances
+    if threshold_type == "standard_deviation":
+        return distances.mean() + amount * distances.std(), distances
+    if threshold_type == "interquartile":
+        q1, q3 = np.percentile(distances, [25, 75])
+        return distances.mean() + amount * (q3 - q1), distances
+    if threshold_type == "gradient":
+        gradient = np.gradient(distances)
+        return np.percentile(gradient, amount), gradient
+    raise ValueError(f"Got unexpected `breakpoint_threshold_type`: {threshold_type}")
+
+
+def combine_sentences(sentences, buffer_size):
+    return [
+        " ".join(sentences[max(0, i - buffer_size):i + 1 + buffer_size])
+        for i in range(len(sentences))
+    ]
+
+
+class SentenceEmbeddingChunker:
+    """Semantic chunker that embeds every sentence once and reuses the result.
+
+    Splits text exactly like langchain_experimental's SemanticChunker (same
+    sentence regex, buffer and breakpoint rules) but computes the distances
+    and thresholds with vectorised NumPy over sentence embeddings gathered
+    from many documents in one `embed_documents` call. With
+    `chunk_vectors="reuse"` the vector of each chunk is the mean of the
+    embeddings of its sentence windows, rescaled to their average norm, so
+    chunks never have to be embedded a second time; `"reencode"` embeds the
+    final chunk texts instead.
+    """
+
+    def __init__(self, embeddings, breakpoint_threshold_type="percentile",
+                 breakpoint_threshold_amount=None, buffer_size=1,
+                 sentence_split_regex=r"(?<=[.?!])\s+", chunk_vectors=CHUNK_VECTORS_REUSE,
+                 sentence_batch_size=SENTENCE_BATCH_SIZE):
+        if chunk_vectors not in CHUNK_VECTOR_MODES:
+            raise ValueError(f"Got unexpected `chunk_vectors`: {chunk_vectors}")
+        self.embeddings = embeddings
+        self.breakpoint_threshold_type = breakpoint_threshold_type
+        self.breakpoint_threshold_amount = (BREAKPOINT_DEFAULTS[breakpoint_threshold_type]
+                                            if breakpoint_threshold_amount is None
+                                            else breakpoint_threshold_amount)
+        self.buffer_size = buffer_size
+        self.sentence_split_regex = sentence_split_regex
+        self.chunk_vectors = chunk_vectors
+        self.sentence_batch_size = sentence_batch_size
+
+    def split_sentences(self, text):
+        return re.split(self.sentence_split_regex, text)
+
+    def chunk_bounds(self, sentence_vectors):
+        """Return the (start, end) sentence ranges of the chunks, end exclusive."""
+        n = len(sentence_vectors)
+        if n == 1 or (self.breakpoint_threshold_type == "gradient" and n == 2):
+            return [(i, i + 1) for i in range(n)]
+        norms = np.linalg.norm(sentence_vectors, axis=1)
+        unit = sentence_vectors / np.where(norms == 0, 1, norms)[:, None]
+        distances = 1 - np.einsum("ij,ij->i", unit[:-1], unit[1:])
+        threshold, values = breakpoint_threshold(distances, self.breakpoint_threshold_type,
+                                                 self.breakpoint_threshold_amount)
+        ends = (np.flatnonzero(values > threshold) + 1).tolist()
+        if not ends or ends[-1] != n:
+            ends.append(n)
+        return list(zip([0] + ends[:-1], ends))
+
+    def chunk_vector(self, sentence_vectors):
+        mean = sentence_vectors.mean(axis=0)
+        scale = np.linalg.norm(sentence_vectors, axis=1).mean()
+        norm = np.linalg.norm(mean)
+        return mean * (scale / norm) if norm else mean
+
+    def _split_batch(self, batch):
+        windows = [window for _, sentences in batch
+                   for window in combine_sentences(sentences, self.buffer_size)]
+        vectors = np.asarray(self.embeddings.embed_documents(windows), dtype=np.float32)
+
+        chunks, chunk_vectors = [], []
+        offset = 0
+        for document, sentences in batch:
+            doc_vectors = vectors[offset:offset + len(sentences)]
+            offset += len(sentences)
+            for start, end in self.chunk_bounds(doc_vectors):
+                text = " ".join(sentences[start:end])
+                if not text.strip():
+                    continue
+                chunks.append(Document(page_content=text, metadata=copy.deepcopy(document.metadata)))
+                chunk_vectors.append(self.chunk_vector(doc_vectors[start:end]))
+
+        if self.chunk_vectors == CHUNK_VECTORS_REENCODE and chunks:
+            chunk_vectors = np.asarray(self.embeddings.embed_documents([chunk.page_content for chunk in chunks]),
+                                       dtype=np.float32)
+        return zip(chunks, chunk_vectors)
+
+    def iter_chunks_with_vectors(self, documents):
+        """Yield (chunk, vector) pairs, embedding sentences of several documents per call."""
+        batch, sentence_count = [], 0
+        for document in documents:
+            sentences = self.split_sentences(document.page_content)
+            batch.append((document, sentences))
+            sentence_count += len(sentences)
+            if sentence_count >= self.sentence_batch_size:
+                yield from self._split_batch(batch)
+                batch, sentence_count = [], 0
+        if batch:
+            yield from self._split_batch(batch)
+
+    def split_documents(self, documents):
+        return [chunk for chunk, _ in self.iter_chunks_with_vectors(documents)]
@@ -0,0 +1,108 @@
+# speculative_retrieval.py
+"""History-aware retrieval that does not wait for the question rewrite.
+
+create_history_aware_retriever makes a blocking LLM call to condense every
+follow-up question before retrieval starts. Here retrieval on the raw
+question runs while the LLM condenses it:
+
+- a question that looks self-contained is not condensed at all;
+- if the condensed question is the raw one, the speculative results are used;
+- otherwise the condensed question is retrieved too and both candidate
+  lists are merged by reciprocal rank.
+
+Stage latencies are added to metadata["retrieval_ms"] (see format_timings).
+"""
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+from embedding_cache import normalize_text
+from hybrid_search import reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+# Words that usually point back into the conversation
+REFERENCE_PATTERN = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|there|then|former|latter|"
+    r"above|previous|previously|earlier|same|such|another|else|again|also|too)\b", re.IGNORECASE)
+FOLLOW_UP_PATTERN = re.compile(r"^\s*(and|but|so|or|what about|how about|why|why not|ok|okay|and then)\b",
+                               re.IGNORECASE)
+# Shorter questions ("Why?", "Tell me more") are almost always follow-ups
+MIN_SELF_CONTAINED_WORDS = 4
+
+_speculative_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-retrieval")
+
+
+def is_self_contained(question):
+    """Cheap guess that a question can be understood without the chat history.
+
+    Errs towards condensing: a false "no" only costs the LLM call that
+    every follow-up used to make.
+    """
+    return (len(question.split()) >= MIN_SELF_CONTAINED_WORDS
+            and not FOLLOW_UP_PATTERN.search(question) and not REFERENCE_PATTERN.search(question))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def merge_candidates(condensed, speculative):
+    """Candidates of both questions fused by reciprocal rank, as many as the longer list."""
+    fused = reciprocal_rank_fusion([condensed, speculative])
+    return [document for document, _ in fused[:max(len(condensed), len(speculative))]]
+
+
+def with_timings(documents, **timings):
+    timings = {**(documents[0].metadata.get("retrieval_ms", {}) if documents else {}), **timings}
+    for document in documents:
+        document.metadata["retrieval_ms"] = timings
+    return documents
+
+
+def create_speculative_retriever(llm, retriever, prompt):
+    """Drop-in replacement for create_history_aware_retriever(llm, retriever, prompt).
+
+    Takes {"input", "chat_history"} and returns the documents for the
+    question as understood in the context of the chat.
+    """
+    condense_chain = prompt | llm | StrOutputParser()
+
+    def retrieve(inputs, config):
+        question = inputs["input"]
+        if not inputs.get("chat_history"):
+            return retriever.invoke(question, config)
+        start = time.perf_counter()
+        if is_self_contained(question):
+            documents = retriever.invoke(question, config)
+            return with_timings(documents, speculative="condense skipped",
+                                end_to_end=(time.perf_counter() - start) * 1000)
+
+        speculative = _speculative_pool.submit(timed, retriever.invoke, question, config)
+        condensed, condense_ms = timed(condense_chain.invoke, inputs, config)
+        condensed = condensed.strip() or question
+        try:
+            speculative_documents, speculative_ms = speculative.result()
+        except Exception:
+            if normalize_text(condensed) == normalize_text(question):
+                raise
+            logger.exception("Speculative retrieval failed, using the condensed question only")
+            speculative_documents, speculative_ms = [], 0.0
+
+        if normalize_text(condensed) == normalize_text(question):
+            end_to_end = (time.perf_counter() - start) * 1000
+            return with_timings(speculative_documents, speculative="reused", condense=condense_ms,
+                                end_to_end=end_to_end, saved=max(0.0, condense_ms + speculative_ms - end_to_end))
+        # Nothing is saved here over condensing first, but the raw question's hits widen the candidates
+        documents = merge_candidates(retriever.invoke(condensed, config), speculative_documents)
+        logger.debug(f"Condensed {question!r} to {condensed!r} in {condense_ms:.0f} ms")
+        return with_timings(documents, speculative="merged", condense=condense_ms,
+                            end_to_end=(time.perf_counter() - start) * 1000)
+
+    return RunnableLambda(retrieve).with_config(run_name="speculative_retriever_chain")
@@ -0,0 +1,115 @@
+# startup.py
+"""Background warm-up at server start and a timing report of the cold start.
+
+`start_warm_up()` runs once per server process: in a background thread it
+imports the heavy modules behind the chat pages, loads and runs the
+embedding model once, and loads the DBs selected last into the shared
+index registry, so the first page render and the first RAG query do not
+pay for them. Each phase is timed; the report is logged when warm-up ends
+and available from `startup_report()`.
+"""
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+LAST_USED_FILE = Path.home() / ".ragbot" / "last_used_dbs.json"
+WARM_UP = os.getenv("RAGBOT_WARM_UP", "1") != "0"
+# Imported in this order so that each phase only counts what the previous ones did not load
+WARM_UP_IMPORTS = ["langchain_core", "langchain.chains", "langchain_community.vectorstores", "template", "img2txt"]
+
+_timings = {}
+_lock = threading.Lock()
+_started = time.perf_counter()
+
+
+@contextmanager
+def timed_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _timings[name] = time.perf_counter() - start
+
+
+def startup_report():
+    """(phase, seconds) pairs in the order the phases finished."""
+    with _lock:
+        return list(_timings.items())
+
+
+def format_report(report):
+    return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in report)
+
+
+def record_last_used(db_names):
+    """Remember the DBs a session selected; the next server start preloads them."""
+    try:
+        LAST_USED_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = LAST_USED_FILE.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(list(db_names)), encoding="utf-8")
+        os.replace(tmp_path, LAST_USED_FILE)
+    except OSError as e:
+        logger.warning(f"Could not record last used DBs: {e}")
+
+
+def last_used():
+    try:
+        return json.loads(LAST_USED_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return []
+
+
+def warm_up():
+    for module in WARM_UP_IMPORTS:
+        with timed_phase(f"import {module}"):
+            importlib.import_module(module)
+
+    from models import EMBEDDING_BACKEND, EMBEDDING_SERVICE, setup_embedding_model
+    from vector_store import get_index_registry
+
+    if not EMBEDDING_SERVICE and EMBEDDING_BACKEND == "torch":
+        with timed_phase("import langchain_huggingface"):
+            importlib.import_module("langchain_huggingface")
+    with timed_phase("load embedding model"):
+        embeddings = setup_embedding_model()
+    # The first forward pass initialises kernels and allocators
+    with timed_phase("first embedding"):
+        embeddings.embed_query("warm-up")
+    registry = get_index_registry()
+    for db_name in last_used():
+        try:
+            with timed_phase(f"load index {db_name}"):
+                with registry.acquire(db_name):
+                    pass
+        except Exception as e:
+            logger.warning(f"Could not preload {db_name}: {e}")
+
+
+def _run_warm_up():
+    try:
+        with timed_phase("warm-up"):
+            warm_up()
+    except Exception:
+        logger.exception("Warm-up failed")
+    logger.info(f"Startup: {format_report(startup_report())} "
+                f"(ready {time.perf_counter() - _started:.2f}s after start)")
+
+
+@st.cache_resource(show_spinner=False)
+def start_warm_up():
+    """Start the warm-up thread, once per server process."""
+    if not WARM_UP:
+        return None
+    thread = threading.Thread(target=_run_warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
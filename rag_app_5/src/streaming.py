@@ -0,0 +1,71 @@
+# streaming.py
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationStats:
+    """Time to first token and decoding speed of one answer, measured from when the turn starts."""
+
+    start: float = field(default_factory=time.perf_counter)
+    first_token: Optional[float] = None
+    end: Optional[float] = None
+    text: str = ""
+
+    @property
+    def ttft_ms(self):
+        return (self.first_token - self.start) * 1000 if self.first_token is not None else None
+
+    @property
+    def tokens(self):
+        return count_tokens(self.text)
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token is None or self.end is None or self.end <= self.first_token:
+            return None
+        return self.tokens / (self.end - self.first_token)
+
+    def as_dict(self):
+        return {"ttft_ms": self.ttft_ms, "tokens": self.tokens, "tokens_per_second": self.tokens_per_second}
+
+    def format(self):
+        if self.first_token is None:
+            return "no tokens"
+        speed = f" at {self.tokens_per_second:.1f} tokens/s" if self.tokens_per_second else ""
+        return f"first token {self.ttft_ms:.0f} ms, {self.tokens} tokens{speed}"
+
+
+def chunk_text(chunk):
+    """Answer text in a chunk of a retrieval chain's stream ({"answer": ...}) or of a chat model's."""
+    if isinstance(chunk, dict):
+        text = chunk.get("answer", "")
+    else:
+        text = getattr(chunk, "content", chunk)
+    return text if isinstance(text, str) else ""
+
+
+def stream_answer(stream, stats, on_context=None):
+    """Yield the answer tokens of `stream` as they arrive, recording them in `stats`.
+
+    With a retrieval chain, `on_context(documents)` is called as soon as
+    retrieval is done, before the first answer token.
+    """
+    for chunk in stream:
+        if on_context is not None and isinstance(chunk, dict) and "context" in chunk:
+            on_context(chunk["context"])
+        text = chunk_text(chunk)
+        if not text:
+            continue
+        if stats.first_token is None:
+            stats.first_token = time.perf_counter()
+        stats.text += text
+        yield text
+    stats.end = time.perf_counter()
+    logger.info(f"Generation: {stats.format()}")
@@ -1,4 +1,5 @@
 import streamlit as st
+from startup import start_warm_up
 
 home_page = st.Page("homepage.py", title="Home", icon="🏚️")
 vec_db_mgnmnt = st.Page("vec_mng.py", title="Vector Database Management", icon="🛠️")
@@ -8,5 +9,7 @@ imgText = st.Page("imageChat.py", title="Image 2 Text", icon="📷")
 
 pg = st.navigation([home_page, chatbot,imgText, vec_db_mgnmnt, personality_mgnmnt])
 st.set_page_config(page_title="AI Assistant", page_icon="🤖", layout='wide')
+# Loads the embedding model and the last used DBs in the background
+start_warm_up()
 
 pg.run()
\ No newline at end of file
@@ -3,7 +3,6 @@
 import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain, create_history_aware_retriever
 from dotenv import load_dotenv
@@ -11,8 +10,17 @@ import os
 from pathlib import Path
 
 from config import ModelProvider
+from chain_registry import get_chain_registry
 from models import setup_openai_model, setup_anthropic_model, setup_groq_model, setup_mistral_model, setup_embedding_model, setup_ollama_model
-from vector_store import VectorStore
+from answer_cache import ANSWER_CACHE_THRESHOLD, answer_cache_key, get_answer_cache
+from chat_history import HISTORY_TOKEN_BUDGET, SummarizingChatHistory
+from hybrid_search import format_timings
+from reranker import RERANK_FETCH_K, RerankingRetriever, get_reranker
+from speculative_retrieval import create_speculative_retriever
+from streaming import GenerationStats, stream_answer
+from context_packing import context_token_budget, create_packing_retriever, format_packing
+from dedup import chunk_sources
+from vector_store import VectorStore, get_index_registry
 import logging
 
 # Set up logging
@@ -22,11 +30,12 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 class RAGChatAppTemplate:
-    def __init__(self, personality, prompt_name, prompt_name_rag):
+    def __init__(self, personality, prompt_name, prompt_name_rag, history_token_budget=HISTORY_TOKEN_BUDGET):
         self.vStore = VectorStore()
         self.personality = personality
         self.prompt_name = prompt_name
         self.prompt_name_rag = prompt_name_rag
+        self.history_token_budget = history_token_budget
         self.initialize_session_state()
 
     def initialize_session_state(self):
@@ -37,6 +46,11 @@ class RAGChatAppTemplate:
             (f"rag_{self.personality}_config", {"configurable": {"session_id": f"rag_{self.personality}_123"}}),
             (f"selected_vector_{self.personality}", None),
             (f"use_vector_db_{self.personality}", False),
+            (f"rerank_{self.personality}", False),
+            (f"speculative_{self.personality}", False),
+            (f"pack_context_{self.personality}", True),
+            (f"answer_cache_{self.personality}", False),
+            (f"answer_cache_threshold_{self.personality}", ANSWER_CACHE_THRESHOLD),
         ]:
             if key not in st.session_state:
                 st.session_state[key] = default_value
@@ -55,19 +69,40 @@ class RAGChatAppTemplate:
         with st.sidebar:
             st.session_state[f"use_vector_db_{self.personality}"] = st.checkbox("Use Vector DB for Context", False)
             if st.session_state[f"use_vector_db_{self.personality}"]:
+                st.session_state[f"rerank_{self.personality}"] = st.checkbox(
+                    "Rerank retrieved chunks", False,
+                    help=f"Score the top {RERANK_FETCH_K} chunks with a cross-encoder and keep only the best ones.")
+                st.session_state[f"speculative_{self.personality}"] = st.checkbox(
+                    "Speculative retrieval", False,
+                    help="Retrieve on the question as asked while the LLM rewrites follow-ups, and skip the "
+                         "rewrite for questions that stand on their own.")
+                st.session_state[f"pack_context_{self.personality}"] = st.checkbox(
+                    "Pack context", True,
+                    help="Drop duplicate passages and trim retrieved chunks to the sentences around the best "
+                         "match, within a token budget for the selected model.")
+                st.session_state[f"answer_cache_{self.personality}"] = st.checkbox(
+                    "Reuse answers to similar questions", False,
+                    help="Answer the first question of a chat from the cache when a near-identical one was "
+                         "already answered from the same DB version with the same model.")
+                if st.session_state[f"answer_cache_{self.personality}"]:
+                    st.session_state[f"answer_cache_threshold_{self.personality}"] = st.slider(
+                        "Similarity threshold", 0.80, 1.00, ANSWER_CACHE_THRESHOLD, 0.01)
                 available_vector_dbs = self.vStore.get_available_vector_dbs()
                 if available_vector_dbs:
-                    selected_vector = st.selectbox(
-                        'Choose Vector DB:',
+                    selected_vector = st.multiselect(
+                        'Choose Vector DBs:',
                         available_vector_dbs,
-                        index=0,
+                        default=available_vector_dbs[:1],
+                        help="Selected DBs are searched in parallel and their results merged.",
                     )
-                    # Update the selected vector store if it has changed
-                    if selected_vector != st.session_state[f"selected_vector_{self.personality}"]:
+                    if not selected_vector:
+                        st.warning('Select at least one Vector DB.')
+                    # Update the selected vector stores if they have changed
+                    elif selected_vector != st.session_state[f"selected_vector_{self.personality}"]:
                         st.session_state[f"selected_vector_{self.personality}"] = selected_vector
                         self.vStore.load_vector_store(selected_vector)
-                        st.session_state.current_vector_db = selected_vector  # Track current vector DB
-                        st.success(f"Vector DB updated to: {selected_vector}")  # Feedback to user
+                        st.session_state.current_vector_db = selected_vector  # Track current vector DBs
+                        st.success(f"Vector DB updated to: {', '.join(selected_vector)}")  # Feedback to user
                         st.rerun()  # Rerun the script to reflect changes
                 else:
                     st.warning('No Vector DB available. Please create a new one.')
@@ -76,7 +111,9 @@ class RAGChatAppTemplate:
                 st.session_state.current_vector_db = None
 
         # Retrieve the current retriever based on user choice
-        retriever = self.vStore.get_retriever() if st.session_state[f"use_vector_db_{self.personality}"] else None
+        retriever = None
+        if st.session_state[f"use_vector_db_{self.personality}"]:
+            retriever = self.vStore.get_retriever(k=RERANK_FETCH_K if st.session_state[f"rerank_{self.personality}"] else 5)
 
         st.sidebar.header("Available LLM Model")
         selected_provider = st.sidebar.selectbox(
@@ -96,11 +133,48 @@ class RAGChatAppTemplate:
 
     def get_session_history(self,session_id: str):
         if session_id not in st.session_state[f"rag_{self.personality}_store"]:
-            st.session_state[f"rag_{self.personality}_store"][session_id] = ChatMessageHistory()
+            st.session_state[f"rag_{self.personality}_store"][session_id] = SummarizingChatHistory(self.history_token_budget)
         return st.session_state[f"rag_{self.personality}_store"][session_id]
 
+    def configure_history(self, llm):
+        """Point the session's history at the current model (for summaries) and the personality's budget."""
+        history = self.get_session_history(st.session_state[f"rag_{self.personality}_config"]["configurable"]["session_id"])
+        history.llm = llm
+        history.token_budget = self.history_token_budget
+
+    def chain_key(self, llm, retriever):
+        """Everything the chain is built from. The client is cached too, so the same id means the same client."""
+        if not retriever:
+            return ("chain", self.personality, id(llm), self.prompt_name)
+        registry = get_index_registry()
+        versions = []
+        for db_name in retriever.db_names:
+            try:
+                versions.append(registry.live_version(db_name))
+            except FileNotFoundError:
+                versions.append(None)
+        return ("chain", self.personality, id(llm), self.prompt_name_rag, tuple(retriever.db_names), tuple(versions),
+                retriever.mode, tuple(sorted(retriever.search_kwargs.items())),
+                st.session_state[f"rerank_{self.personality}"], st.session_state[f"speculative_{self.personality}"],
+                self.context_token_budget())
+
+    def context_token_budget(self):
+        """Token budget of the packed context for the selected model, or None when packing is off."""
+        if not st.session_state[f"pack_context_{self.personality}"]:
+            return None
+        return context_token_budget(st.session_state.get("selected_model"))
+
     def setup_chain(self, llm, retriever):
+        """The compiled chain for the current settings, shared across reruns and sessions by the chain registry."""
+        if not st.session_state[f"use_vector_db_{self.personality}"]:
+            retriever = None
+        return get_chain_registry().get(self.chain_key(llm, retriever), lambda: self.build_chain(llm, retriever))
+
+    def build_chain(self, llm, retriever):
         if st.session_state[f"use_vector_db_{self.personality}"] and retriever:
+            if st.session_state[f"rerank_{self.personality}"]:
+                # Over-fetched candidates are cut down to the best few before they reach the prompt
+                retriever = RerankingRetriever(base_retriever=retriever, reranker=get_reranker())
             # Use the existing RAG chain setup
             contextualize_q_system_prompt = """
                 Given a chat history and the latest user question which might reference context in the chat history,
@@ -112,7 +186,13 @@ class RAGChatAppTemplate:
                 MessagesPlaceholder("chat_history"),
                 ("human", "{input}"),
             ])
-            history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+            if st.session_state[f"speculative_{self.personality}"]:
+                history_aware_retriever = create_speculative_retriever(llm, retriever, contextualize_q_prompt)
+            else:
+                history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+            if self.context_token_budget():
+                # Deduplicated and trimmed chunks, best first, up to the model's context budget
+                history_aware_retriever = create_packing_retriever(history_aware_retriever, self.context_token_budget())
 
             qa_prompt = ChatPromptTemplate.from_messages([
                 ("system", self.prompt_name_rag),
@@ -151,6 +231,34 @@ class RAGChatAppTemplate:
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
 
+    def answer_cache_enabled(self):
+        """The answer cache is only used for the first question of a chat: later ones may depend on the history."""
+        config = st.session_state[f"rag_{self.personality}_config"]
+        return (st.session_state[f"answer_cache_{self.personality}"] and bool(st.session_state.vector_store)
+                and not self.get_session_history(config["configurable"]["session_id"]).messages)
+
+    def answer_cache_key(self):
+        return answer_cache_key(self.personality, get_index_registry(), st.session_state.vector_store,
+                                st.session_state.get("selected_model"))
+
+    def lookup_cached_answer(self, prompt):
+        if not self.answer_cache_enabled():
+            return None
+        embedding = get_index_registry().embeddings.embed_query(prompt)
+        found = get_answer_cache().lookup(self.answer_cache_key(), embedding,
+                                          st.session_state[f"answer_cache_threshold_{self.personality}"])
+        if found is not None:
+            # Keep the chain's memory in step, as if the question had been answered
+            history = self.get_session_history(st.session_state[f"rag_{self.personality}_config"]["configurable"]["session_id"])
+            history.add_user_message(prompt)
+            history.add_ai_message(found[0].answer)
+        return found
+
+    def store_cached_answer(self, prompt, answer):
+        # The query embedding is still in the LRU from retrieval
+        embedding = get_index_registry().embeddings.embed_query(prompt)
+        get_answer_cache().store(self.answer_cache_key(), embedding, prompt, answer)
+
     def handle_user_input(self, conversational_chain):
         if prompt := st.chat_input("Hi! How can I help you?", key=f'chat_input_{self.personality}'):
             st.session_state[f"rag_{self.personality}_messages"].append({"role": "user", "content": prompt})
@@ -158,26 +266,55 @@ class RAGChatAppTemplate:
                 st.markdown(prompt)
 
             with st.chat_message("assistant"):
+                stats = None
                 try:
-                    if st.session_state[f"use_vector_db_{self.personality}"] : 
-                        with st.spinner("Thinking🤔"):
-                            response = conversational_chain.invoke({"input": prompt}, config=st.session_state[f"rag_{self.personality}_config"])
-                            context_list = list(set(context.metadata['source'] for context in response['context']))
-                            answer = f"{response['answer']}\n\n📌 Source: {', '.join(context_list)}"
-                            response = st.write(answer)
+                    if st.session_state[f"use_vector_db_{self.personality}"] and (cached := self.lookup_cached_answer(prompt)):
+                        answer = cached[0].answer
+                        response = st.write(answer)
+                        st.caption(f"Cached answer to “{cached[0].question}” (similarity {cached[1]:.2f})")
+                    elif st.session_state[f"use_vector_db_{self.personality}"] :
+                        cache_question = self.answer_cache_enabled()
+                        stats = GenerationStats()
+                        sources = st.empty()
+                        sources.caption("Thinking🤔")
+                        retrieved = {}
+
+                        def show_sources(context):
+                            # Shown as soon as retrieval is done, while the answer is generated
+                            retrieved["context_list"] = list(dict.fromkeys(f"{document.metadata['db']}: {source}" if 'db' in document.metadata else source
+                                                                           for document in context
+                                                                           for source in chunk_sources(document.metadata)))
+                            retrieved["timings"] = next((document.metadata.get("retrieval_ms") for document in context), None)
+                            retrieved["packing"] = next((document.metadata.get("packing") for document in context), None)
+                            sources.caption(f"📌 Source: {', '.join(retrieved['context_list'])}")
+
+                        stream = conversational_chain.stream({"input": prompt}, config=st.session_state[f"rag_{self.personality}_config"])
+                        st.write_stream(stream_answer(stream, stats, on_context=show_sources))
+                        answer = f"{stats.text}\n\n📌 Source: {', '.join(retrieved.get('context_list', []))}"
+                        if retrieved.get("timings"):
+                            st.caption(f"Retrieval: {format_timings(retrieved['timings'])}")
+                        if retrieved.get("packing"):
+                            st.caption(f"Context: {format_packing(retrieved['packing'])}")
+                        st.caption(f"Generation: {stats.format()}")
+                        if cache_question:
+                            self.store_cached_answer(prompt, answer)
                     else:
-                        # When not using vector DB, response is an AIMessage
+                        # When not using vector DB, the stream yields AIMessageChunks
+                        stats = GenerationStats()
                         stream = conversational_chain.stream({"input": prompt}, config=st.session_state[f"rag_{self.personality}_config"])
-                        response = st.write_stream(stream)
+                        response = st.write_stream(stream_answer(stream, stats))
+                        st.caption(f"Generation: {stats.format()}")
                 except Exception as e:
                     st.info(f"An error occurred: {str(e)}. Please check your API key or try again.")
                     st.stop()
-            st.session_state[f"rag_{self.personality}_messages"].append({"role": "assistant", "content": answer if st.session_state[f"use_vector_db_{self.personality}"] else response})
+            st.session_state[f"rag_{self.personality}_messages"].append({"role": "assistant", "content": answer if st.session_state[f"use_vector_db_{self.personality}"] else response,
+                                                                        "generation": stats.as_dict() if stats else None})
 
 
     def run(self, welcome_string):
         st.markdown(welcome_string)
         llm, retriever = self.setup_sidebar()
+        self.configure_history(llm)
         conversational_chain = self.setup_chain(llm, retriever)
         self.clear_chat()
         self.display_chat_messages()
@@ -0,0 +1,28 @@
+# tokens.py
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+ENCODING_NAME = "cl100k_base"
+# Rough size of a token in English text when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    """The tiktoken encoding, or None if tiktoken is missing or its data cannot be loaded (e.g. offline)."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:
+        logger.info(f"tiktoken unavailable ({e}), estimating tokens as characters / {CHARS_PER_TOKEN}")
+        return None
+
+
+def count_tokens(text):
+    """Number of tokens in `text`: exact for OpenAI models, a close estimate for others."""
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,417 @@
+# vector_db_builder.py
+import json
+import logging
+import shutil
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from ann_index import (
+    INDEX_FLAT, COMPRESSION_NONE, RescoringIndex, resolve_index_spec, build_index, evaluate_index, format_report,
+)
+from dedup import NearDuplicateIndex, remove_chunk_sources
+from ingest_pipeline import run_pipeline
+from pdf_parser import parse_pdfs, ParseResult, PARSE_WORKERS, PARSE_TIMEOUT
+from s3_source import get_s3_client, list_pdf_objects, download_objects
+from semantic_chunker import SentenceEmbeddingChunker, CHUNK_VECTORS_REUSE, CHUNK_VECTORS_REENCODE
+from vector_db_storage import (
+    DOCSTORE_FILE, append_vector_db, load_vector_db, save_vector_db, load_index_info, load_signatures, flat_vectors,
+    migrate_if_legacy,
+)
+from vector_db_versions import current_version, new_staging_dir, publish_version
+from vector_db_manifest import (
+    load_manifest, save_manifest, new_manifest, diff_local_folder, diff_objects, fingerprint_file,
+)
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path.home()/'.ragbot'
+VECTOR_DB_DIR = ROOT_DIR/"vector_dbs"
+VECTOR_DB_DIR.mkdir(parents=True, exist_ok=True)
+CONTEXT_DIR = ROOT_DIR/"context_folder"
+CONTEXT_DIR.mkdir(parents=True, exist_ok=True)
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+class BuildError(Exception):
+    pass
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class BuildReporter:
+    """Receives the progress of a build. This one only logs; jobs persist it."""
+
+    def message(self, text):
+        logger.info(text)
+
+    def parsed(self, result, done, total):
+        pass
+
+    def batch(self, stats):
+        pass
+
+    def cancelled(self):
+        return False
+
+
+def iter_documents(source_type, source, file_names=None, aws_config=None, reporter=None,
+                   parse_workers=PARSE_WORKERS, parse_timeout=PARSE_TIMEOUT, s3_objects=None):
+    """Yield the documents of a source one at a time; `file_names` restricts the load to those files.
+
+    S3 objects are downloaded concurrently and handed to the parse pool as
+    they arrive; pass `s3_objects` to reuse an existing listing of the bucket.
+    """
+    reporter = reporter or BuildReporter()
+    failures = []
+    if source_type == "local":
+        folder = CONTEXT_DIR/source
+        if not folder.exists():
+            raise BuildError(f"Unable to find {folder}. Please create the folder or provide different folder name.")
+        pdfs = [pdf for pdf in Path.iterdir(folder) if pdf.is_file()]
+        if len(pdfs) < 1:
+            raise BuildError("No Document(s) found.")
+        logger.info(f"Found {len(pdfs)} pdfs in the location")
+        if file_names is not None:
+            pdfs = [pdf for pdf in pdfs if pdf.name in file_names]
+        sources, total = pdfs, len(pdfs)
+    elif source_type == "s3":
+        client = get_s3_client(aws_config)
+        if s3_objects is None:
+            s3_objects = list(list_pdf_objects(client, source))
+        if not s3_objects:
+            raise BuildError(f"No PDF documents found in S3 bucket - {source}")
+        logger.info(f"Found {len(s3_objects)} pdfs in the bucket")
+        if file_names is not None:
+            s3_objects = [s3_object for s3_object in s3_objects if s3_object.key in file_names]
+
+        def on_error(s3_object, error):
+            failures.append(ParseResult(s3_object.key, error=f"download failed: {error}"))
+
+        sources = download_objects(client, source, s3_objects, on_error=on_error)
+        total = len(s3_objects)
+    else:
+        raise BuildError(f"Unknown source type '{source_type}'.")
+
+    def on_progress(result, done, total):
+        reporter.parsed(result, done, total)
+        if reporter.cancelled():
+            raise BuildCancelled()
+
+    for result in parse_pdfs(sources, workers=parse_workers, timeout=parse_timeout,
+                             on_progress=on_progress, total=total):
+        if not result.ok:
+            failures.append(result)
+            continue
+        yield Document(
+            page_content=result.text,
+            metadata={"source": result.name},
+        )
+    if failures:
+        reporter.message(f"Skipped {len(failures)} document(s) that could not be loaded: "
+                         + "; ".join(f"{result.name}: {result.error}" for result in failures))
+
+
+def get_text_splitter(threshold_type, embedding_model, chunk_vectors=CHUNK_VECTORS_REUSE):
+    return SentenceEmbeddingChunker(
+        embedding_model,
+        breakpoint_threshold_type=threshold_type,
+        chunk_vectors=chunk_vectors
+    )
+
+
+def release_chunks(vector_db, released_files, kept_files):
+    """Remove the chunks of `released_files` ({name: ids}) that no file in `kept_files` still references.
+
+    Chunks shared with kept files (merged near-duplicates) stay, without
+    the released files in their sources.
+    """
+    kept_ids = {id_ for entry in kept_files.values() for id_ in entry["ids"]}
+    released_ids = {id_ for ids in released_files.values() for id_ in ids} & set(vector_db.index_to_docstore_id.values())
+    for id_ in released_ids & kept_ids:
+        remove_chunk_sources(vector_db.docstore.search(id_).metadata, set(released_files))
+    if released_ids - kept_ids:
+        vector_db.delete(list(released_ids - kept_ids))
+
+
+class VectorDBBuild:
+    """Create or incrementally resync one vector DB, with checkpoints in `work_dir`.
+
+    A create ingests the whole source. A resync diffs the source against the
+    manifest of the published DB (see vector_db_manifest), removes the vectors
+    of modified and deleted files and ingests only added and modified ones;
+    without a matching manifest it rebuilds from scratch. The published DB is
+    only replaced when the build finishes: it is written to a staging
+    directory and published as a new version (see vector_db_versions), so
+    readers never see a partially written DB.
+
+    Chunks are indexed flat while ingesting; `index_type` (see ann_index)
+    is built from those vectors when publishing, with a recall/latency report.
+
+    With `dedup`, near-duplicate chunks (see dedup) are embedded once, also
+    against chunks already in the DB. The manifest then lists the surviving
+    chunk's id under every file containing it, so a chunk is only removed
+    when no remaining file references it.
+
+    Every `checkpoint_every` chunks the working index and the list of fully
+    ingested files are saved to `work_dir`, appending only what was added
+    since the previous checkpoint. Running a build again with the
+    same `work_dir` resumes from the last checkpoint: the vectors of the file
+    that was in progress are dropped and the remaining files are ingested.
+    """
+
+    def __init__(self, db_name, action, threshold_type, source_type, source, embedding_model, work_dir,
+                 chunk_vectors=CHUNK_VECTORS_REUSE, aws_config=None, reporter=None,
+                 parse_workers=PARSE_WORKERS, parse_timeout=PARSE_TIMEOUT, checkpoint_every=2000,
+                 index_type=INDEX_FLAT, compression=COMPRESSION_NONE, rescore=False, dedup=True):
+        self.db_name = db_name
+        self.action = action
+        self.threshold_type = threshold_type
+        self.source_type = source_type
+        self.source = source
+        self.embedding_model = embedding_model
+        self.work_dir = Path(work_dir)
+        self.chunk_vectors = chunk_vectors
+        self.aws_config = aws_config
+        self.reporter = reporter or BuildReporter()
+        self.parse_workers = parse_workers
+        self.parse_timeout = parse_timeout
+        self.checkpoint_every = checkpoint_every
+        self.index_type = index_type
+        self.compression = compression
+        self.rescore = rescore
+        self.dedup = dedup
+        self.db_path = VECTOR_DB_DIR / db_name
+        self._s3_objects = None
+        # Directory the working DB was loaded from, whose stored MinHash signatures are reused
+        self._loaded_from = None
+        # Vectors of the working DB already in the checkpoint; 0 until the first one of this run
+        self._checkpointed = 0
+
+    def s3_objects(self):
+        """The PDF objects of the bucket, listed once per build."""
+        if self._s3_objects is None:
+            client = get_s3_client(self.aws_config)
+            self._s3_objects = {s3_object.key: s3_object for s3_object in list_pdf_objects(client, self.source)}
+        return self._s3_objects
+
+    def source_names(self):
+        if self.source_type == "local":
+            return {path.name for path in (CONTEXT_DIR/self.source).iterdir() if path.is_file()}
+        return set(self.s3_objects())
+
+    def fingerprint(self, name):
+        if self.source_type == "local":
+            return fingerprint_file(CONTEXT_DIR/self.source/name)
+        return self.s3_objects()[name].fingerprint()
+
+    def documents(self, file_names=None):
+        s3_objects = list(self.s3_objects().values()) if self.source_type == "s3" else None
+        return iter_documents(self.source_type, self.source, file_names, self.aws_config, self.reporter,
+                              self.parse_workers, self.parse_timeout, s3_objects=s3_objects)
+
+    def plan(self):
+        """Return the initial state and working index of a fresh build."""
+        state = {"files": {}, "todo": None, "in_progress": None, "summary": ""}
+        if self.action != "resync":
+            return state, None
+        _, published_path = current_version(self.db_path)
+        if published_path is None:
+            raise BuildError(f"Vector database '{self.db_name}' does not exist.")
+        try:
+            if migrate_if_legacy(self.db_path):
+                self.reporter.message(f"Migrated '{self.db_name}' from the pickle format.")
+                _, published_path = current_version(self.db_path)
+        except Exception:
+            # Treated like a DB without a matching manifest: rebuilt from its sources
+            logger.exception(f"Migrating {self.db_path} failed")
+            self.reporter.message(f"'{self.db_name}' is in the old pickle format and could not be migrated, "
+                                  f"rebuilding from scratch.")
+            return state, None
+
+        manifest = load_manifest(published_path)
+        # DBs built before chunk vectors were configurable embedded every chunk text
+        if (manifest is None or manifest["threshold_type"] != self.threshold_type
+                or manifest["source_type"] != self.source_type or manifest["source"] != self.source
+                or manifest.get("chunk_vectors", CHUNK_VECTORS_REENCODE) != self.chunk_vectors):
+            self.reporter.message(f"No matching manifest for '{self.db_name}', rebuilding from scratch.")
+            return state, None
+
+        if self.source_type == "local":
+            if not (CONTEXT_DIR/self.source).exists():
+                raise BuildError(f"Unable to find {CONTEXT_DIR/self.source}. Please create the folder or provide different folder name.")
+            diff = diff_local_folder(manifest, CONTEXT_DIR/self.source)
+        else:
+            diff = diff_objects(manifest, {name: s3_object.fingerprint()
+                                           for name, s3_object in self.s3_objects().items()})
+        state["summary"] = (f"{len(diff.added)} added, {len(diff.modified)} modified, "
+                            f"{len(diff.deleted)} deleted, {len(diff.unchanged)} unchanged")
+        self.reporter.message(f"Resync of '{self.db_name}': {state['summary']}")
+        state["files"] = {name: {**manifest["files"][name], **fingerprint}
+                          for name, fingerprint in diff.unchanged.items()}
+        state["todo"] = [*diff.added, *diff.modified]
+        if not diff.changed and self.requested_index() == load_index_info(published_path).get("requested"):
+            state["unchanged"] = True
+            return state, None
+
+        vector_db = load_vector_db(published_path, self.embedding_model, lazy=False)
+        self._loaded_from = published_path
+        release_chunks(vector_db, {name: manifest["files"][name]["ids"] for name in [*diff.modified, *diff.deleted]},
+                       state["files"])
+        return state, vector_db
+
+    def load_checkpoint(self):
+        checkpoint_path = self.work_dir / CHECKPOINT_FILE
+        if not checkpoint_path.exists():
+            return None, None
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        vector_db = None
+        if (self.work_dir / DOCSTORE_FILE).exists():
+            vector_db = load_vector_db(self.work_dir, self.embedding_model, lazy=False)
+            self._loaded_from = self.work_dir
+            partial = state["in_progress"]
+            if partial and partial["ids"]:
+                release_chunks(vector_db, {partial["source"]: partial["ids"]}, state["files"])
+        state["in_progress"] = None
+        self.reporter.message(f"Resuming from checkpoint with {len(state['files'])} files done.")
+        return state, vector_db
+
+    def save_checkpoint(self, state, vector_db, signatures=None):
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self._checkpointed = append_vector_db(vector_db, self.work_dir, self._checkpointed, signatures)
+        tmp_path = self.work_dir / (CHECKPOINT_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        tmp_path.replace(self.work_dir / CHECKPOINT_FILE)
+
+    def run(self):
+        # Until the first checkpoint the published DB is untouched, so an
+        # interrupted build simply plans again.
+        state, vector_db = self.load_checkpoint()
+        if state is None:
+            state, vector_db = self.plan()
+        if state.get("unchanged"):
+            # Only fingerprints (e.g. touched mtimes) can differ, so the live version's manifest is refreshed in place
+            save_manifest(current_version(self.db_path)[1], self.new_manifest(state))
+            self.reporter.message(f"Vector database '{self.db_name}' is already up to date.")
+            return state
+
+        done = set(state["files"])
+        if state["todo"] is not None:
+            todo = set(state["todo"]) - done
+        elif done:
+            todo = self.source_names() - done
+        else:
+            todo = None
+        fingerprints = {}
+        last_checkpoint = 0
+        dedup = self.near_duplicate_index(vector_db)
+        signatures = dedup.signatures if dedup is not None else None
+
+        def track(documents):
+            for document in documents:
+                source = document.metadata["source"]
+                if source in done:
+                    continue
+                fingerprints[source] = self.fingerprint(source)
+                yield document
+
+        def on_batch(vector_db, batch, stats):
+            nonlocal last_checkpoint
+            self.reporter.batch(stats)
+            if self.reporter.cancelled():
+                raise BuildCancelled()
+            if stats.chunks - last_checkpoint < self.checkpoint_every:
+                return
+            # Chunks arrive in document order, so every file pulled before the
+            # source of the last chunk is complete.
+            sources = list(stats.ids_by_source)
+            current = batch[-1].metadata["source"]
+            for source in sources[:sources.index(current)]:
+                state["files"][source] = {**fingerprints[source], "ids": stats.ids_by_source[source]}
+            state["in_progress"] = {"source": current, "ids": stats.ids_by_source[current]}
+            self.save_checkpoint(state, vector_db, signatures)
+            last_checkpoint = stats.chunks
+
+        if todo is None or todo:
+            documents = track(self.documents(file_names=todo))
+            vector_db, stats = run_pipeline(documents, get_text_splitter(self.threshold_type, self.embedding_model,
+                                                                         self.chunk_vectors),
+                                            self.embedding_model, vector_db=vector_db, on_batch=on_batch,
+                                            dedup=dedup)
+            # Files that failed to parse stay out of the manifest so the next resync retries them
+            for source, ids in stats.ids_by_source.items():
+                state["files"][source] = {**fingerprints[source], "ids": ids}
+            message = f"{stats.chunks} chunks created from {stats.documents} documents."
+            if self.dedup:
+                state["dedup_report"] = (f"Near-duplicates: {stats.duplicates} of {stats.chunks} chunks merged "
+                                         f"({stats.dedup_ratio:.1%} dedup ratio), {stats.embeddings} embedded")
+                message += f" {state['dedup_report']}."
+            self.reporter.message(message)
+
+        if vector_db is None:
+            raise BuildError("No chunks could be created from the source, vector database not created.")
+        self.publish(state, vector_db, signatures)
+        return state
+
+    def near_duplicate_index(self, vector_db):
+        """A NearDuplicateIndex holding the chunks already in `vector_db`, or None without dedup.
+
+        Signatures stored with the DB are reused; only chunks saved without
+        one (e.g. by a build without dedup) are MinHashed again.
+        """
+        if not self.dedup:
+            return None
+        dedup = NearDuplicateIndex()
+        if vector_db is not None:
+            stored = load_signatures(self._loaded_from) if self._loaded_from is not None else {}
+            missing = []
+            for id_ in vector_db.index_to_docstore_id.values():
+                if id_ in stored:
+                    dedup.add(id_, stored[id_])
+                else:
+                    missing.append(id_)
+            if missing:
+                self.reporter.message(f"Indexing {len(missing)} existing chunks for near-duplicate detection...")
+                dedup.add_texts((id_, vector_db.docstore.search(id_).page_content) for id_ in missing)
+        return dedup
+
+    def new_manifest(self, state):
+        manifest = new_manifest(self.threshold_type, self.source_type, self.source)
+        manifest["chunk_vectors"] = self.chunk_vectors
+        manifest["files"] = state["files"]
+        return manifest
+
+    def build_index(self, state, vector_db):
+        """Build the requested index type over the working flat index and report its recall and latency."""
+        vectors = flat_vectors(vector_db.index)
+        spec = resolve_index_spec(self.index_type, *vectors.shape, compression=self.compression, rescore=self.rescore)
+        self.reporter.message(f"Building {spec['type']} index over {len(vectors)} vectors...")
+        index = None
+        if spec["type"] != INDEX_FLAT or spec["compression"] != COMPRESSION_NONE:
+            index = build_index(vectors, spec)
+        evaluated = RescoringIndex(index, vectors) if spec["rescore"] else index or vector_db.index
+        report = evaluate_index(evaluated, spec, vectors)
+        state["index_report"] = format_report(spec, report)
+        self.reporter.message(state["index_report"])
+        return index, {**spec, "requested": self.requested_index(), "report": report}
+
+    def requested_index(self):
+        return {"type": self.index_type, "compression": self.compression, "rescore": self.rescore}
+
+    def publish(self, state, vector_db, signatures=None):
+        """Write the DB to a staging directory and atomically make it the live version."""
+        staging = new_staging_dir(self.db_path)
+        # A resync only applies its changes to the chunks of the live version
+        base = current_version(self.db_path)[1] if self.action == "resync" else None
+        try:
+            save_vector_db(vector_db, staging, *self.build_index(state, vector_db), signatures=signatures, base=base)
+            save_manifest(staging, self.new_manifest(state))
+            publish_version(self.db_path, staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -3,14 +3,17 @@ from pathlib import Path
 from dotenv import load_dotenv
 import logging
 import os
-from langchain_community.document_loaders import S3DirectoryLoader, DirectoryLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 import shutil
-from langchain_core.documents import Document
-from models import setup_embedding_model
+from models import setup_document_embedding_model
+from semantic_chunker import CHUNK_VECTORS_REUSE, CHUNK_VECTORS_REENCODE
+from pdf_parser import PARSE_WORKERS, PARSE_TIMEOUT
+from ann_index import (
+    INDEX_TYPES, INDEX_FLAT, INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_HNSW,
+    COMPRESSIONS, COMPRESSION_NONE, COMPRESSION_INT8, COMPRESSION_PQ,
+)
+from vector_db_builder import ROOT_DIR, VECTOR_DB_DIR, CONTEXT_DIR
+from vector_db_versions import list_databases
+from ingest_jobs import JobRunner, load_jobs
 
 # Load environment variables
 load_dotenv()
@@ -19,17 +22,27 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-ROOT_DIR = Path.home()/'.ragbot'
-VECTOR_DB_DIR = ROOT_DIR/"vector_dbs"
-VECTOR_DB_DIR.mkdir(parents=True, exist_ok=True)
-CONTEXT_DIR = ROOT_DIR/"context_folder"
-CONTEXT_DIR.mkdir(parents=True, exist_ok=True)
 THRESHOLD_TYPES = [
     'percentile',
     'standard_deviation',
     'interquartile',
     'gradient'
 ]
+CHUNK_VECTOR_OPTIONS = {
+    "Reuse sentence embeddings": CHUNK_VECTORS_REUSE,
+    "Re-encode chunks": CHUNK_VECTORS_REENCODE,
+}
+INDEX_TYPE_LABELS = {
+    INDEX_FLAT: "Flat (exact)",
+    INDEX_IVF_FLAT: "IVF-Flat",
+    INDEX_IVF_PQ: "IVF-PQ (compressed)",
+    INDEX_HNSW: "HNSW",
+}
+COMPRESSION_LABELS = {
+    COMPRESSION_NONE: "None (float32)",
+    COMPRESSION_INT8: "Scalar int8 (4x smaller)",
+    COMPRESSION_PQ: "Product quantization (16x smaller)",
+}
 
 # Custom CSS to improve aesthetics
 st.markdown("""
@@ -69,74 +82,58 @@ def get_aws_config():
         st.stop()
     return aws_config
 
-def load_documents(source_type, folder_name=None, bucket_name=None):
-    if source_type == "local":
-        if (CONTEXT_DIR/folder_name).exists():
-            if (len([pdf for pdf in Path.iterdir(CONTEXT_DIR/folder_name)])) < 1:
-                st.warning("No Document(s) found.")   
-                st.stop() 
-            logger.info(f"Found {len([pdf for pdf in Path.iterdir(CONTEXT_DIR/folder_name)])} pdfs in the location")
-            documents= []
-            for pdf in Path.iterdir(CONTEXT_DIR/folder_name):
-                pages= []
-                loader = PyPDFLoader(pdf)
-                for page in loader.lazy_load():
-                    pages.append(page)
-                logger.info(f"{pdf.name} has {len(pages)} pages")
-                content = ''
-                for page in pages:
-                    pdf_name = Path(page.metadata['source']).name
-                    content += page.page_content
-                document = Document(
-                    page_content=content,
-                    metadata={"source": pdf.name},
-                )
-                documents.append(document)
-            return documents
-        else:
-            st.warning(f"Unable to find {CONTEXT_DIR/folder_name}. Please create the folder or provide different folder name.")
-    elif source_type == "s3":
-        aws_config = get_aws_config()
-        loader = S3DirectoryLoader(bucket_name, **aws_config)
-        documents = loader.load()
-        if len(documents) >= 1:
-            return documents
-        else:
-            st.warning(f"No PDF documents found in S3 bucket - {bucket_name}")
-    return None
-
-def create_vector_db(documents, db_name, threshold_type):
-    st.info("Creating vector database...")
-    embedding_model = setup_embedding_model()
-    text_splitter = SemanticChunker(
-        embedding_model, 
-        breakpoint_threshold_type=threshold_type
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(setup_document_embedding_model)
+
+def submit_build(action, db_name, threshold_type, source_type, folder_name, bucket_name, chunk_vectors,
+                 aws_config=None):
+    job, created = get_job_runner().submit(
+        db_name, action, threshold_type, source_type, folder_name or bucket_name, chunk_vectors,
+        parse_workers=st.session_state.get("parse_workers", PARSE_WORKERS),
+        parse_timeout=st.session_state.get("parse_timeout", PARSE_TIMEOUT),
+        aws_config=aws_config,
+        index_type=st.session_state.get("index_type", INDEX_FLAT),
+        compression=st.session_state.get("compression", COMPRESSION_NONE),
+        rescore=st.session_state.get("rescore", False),
     )
-    logger.info(f"Total number of documents: {len(documents)}")
-    chunks = text_splitter.split_documents(documents)
-    st.info(f"{len(chunks)} chunks created from {len(documents)} documents.")
-
-    vector_db = FAISS.from_documents(chunks, embedding_model)
-
-    db_path = VECTOR_DB_DIR / db_name
-    vector_db.save_local(str(db_path))
-    st.success(f"Vector database '{db_name}' created successfully.")
+    if created:
+        st.success(f"Job #{job.id} queued for '{db_name}'. Progress is shown below.")
+    else:
+        st.warning(f"Job #{job.id} is already {job.status} for '{db_name}'.")
 
-def resync_vector_db(db_name, documents, threshold_type):
-    db_path = VECTOR_DB_DIR / db_name
-    if not db_path.exists():
-        st.error(f"Vector database '{db_name}' does not exist.")
+@st.fragment(run_every=2)
+def show_jobs():
+    """Live view of recent ingestion jobs, refreshed every two seconds."""
+    jobs = load_jobs()
+    if not jobs:
         return
-
-    st.info(f"Deleting existing vector database '{db_name}'...")
-    shutil.rmtree(db_path)
-
-    create_vector_db(documents, db_name, threshold_type)
-    st.success(f"Vector database '{db_name}' resynced successfully.")
+    st.subheader("Ingestion Jobs")
+    for job in jobs:
+        with st.container(border=True):
+            col1, col2 = st.columns([4, 1])
+            col1.markdown(f"**#{job.id} {job.action} `{job.db_name}`** from {job.source_type} `{job.source}` "
+                          f"— {job.status}")
+            if job.active and col2.button("Cancel", key=f"cancel_job_{job.id}"):
+                get_job_runner().cancel(job.id)
+            if job.active and job.files_total:
+                st.progress(job.files_done / job.files_total,
+                            text=f"Parsed {job.files_done}/{job.files_total} documents")
+            if job.started_at:
+                pages_rate, chunks_rate, embeddings_rate = job.rates()
+                m1, m2, m3 = st.columns(3)
+                m1.metric("Pages/s", f"{pages_rate:.1f}", f"{job.pages} pages", delta_color="off")
+                m2.metric("Chunks/s", f"{chunks_rate:.1f}", f"{job.chunks} chunks", delta_color="off")
+                m3.metric("Embeddings/s", f"{embeddings_rate:.1f}", f"{job.embeddings} embeddings", delta_color="off")
+            if job.message:
+                st.caption(job.message)
 
 def delete_vector_db(db_name):
     db_path = VECTOR_DB_DIR / db_name
-    if db_path.exists():
+    job = get_job_runner().active_job(db_name)
+    if job:
+        st.error(f"Vector database '{db_name}' is being built by job #{job.id}. Cancel it first.")
+    elif db_path.exists():
         shutil.rmtree(db_path)
         st.success(f"Vector database '{db_name}' deleted successfully.")
     else:
@@ -160,7 +157,7 @@ def main():
         st.subheader("Configuration")
         if action in ["Create new vector database", "Resync existing vector database"]:
             if action == "Resync existing vector database":
-                vector_databases = [x.name for x in VECTOR_DB_DIR.iterdir() if x.is_dir()]
+                vector_databases = list_databases(VECTOR_DB_DIR)
                 db_name = st.selectbox("Select the vector database to resync:", vector_databases)
             if action == "Create new vector database":
                 db_name = st.text_input("Enter the name for the new vector database:")
@@ -171,12 +168,46 @@ def main():
                 THRESHOLD_TYPES,
                 help="Choose the method for determining chunk breakpoints"
             )
+            chunk_vectors = CHUNK_VECTOR_OPTIONS[st.selectbox(
+                "Chunk vectors:",
+                list(CHUNK_VECTOR_OPTIONS),
+                help="Reusing the sentence embeddings computed for chunking avoids embedding every chunk a second time"
+            )]
+            st.selectbox(
+                "Index type:",
+                INDEX_TYPES,
+                format_func=INDEX_TYPE_LABELS.get,
+                key="index_type",
+                help="Approximate indexes answer faster on large DBs at some cost in recall. "
+                     "Their parameters are tuned to the number of chunks, and the build reports "
+                     "recall@5 and p50/p99 latency against exact search."
+            )
+            compression = st.selectbox(
+                "Vector compression:",
+                COMPRESSIONS,
+                format_func=COMPRESSION_LABELS.get,
+                key="compression",
+                help="Compressed vectors cut the memory of a loaded DB. IVF-PQ is always PQ-compressed."
+            )
+            st.checkbox(
+                "Re-score top candidates with full-precision vectors",
+                key="rescore",
+                disabled=compression == COMPRESSION_NONE and st.session_state.get("index_type") != INDEX_IVF_PQ,
+                help="Fetches 4x the candidates from the compressed index and re-ranks them exactly, "
+                     "reading only those vectors from disk"
+            )
 
             source_type = st.selectbox("Select source type", ["local", "s3"])
             if source_type == "local":
                 context_folders = [x.name for x in CONTEXT_DIR.iterdir() if x.is_dir()]
                 folder_name = st.selectbox("Select the folder containing PDF files:", context_folders)
                 bucket_name = None
+                aws_config = None
+                with st.expander("Parsing settings"):
+                    st.number_input("Parser worker processes", min_value=1, value=PARSE_WORKERS, key="parse_workers",
+                                    help="Number of processes parsing PDFs in parallel")
+                    st.number_input("Per-file timeout (seconds)", min_value=1.0, value=PARSE_TIMEOUT, key="parse_timeout",
+                                    help="A PDF taking longer than this to parse is skipped")
             if source_type == "s3":
                 bucket_name = st.text_input("Enter the S3 bucket name containing PDF files:")
                 if not bucket_name:
@@ -187,19 +218,22 @@ def main():
                     aws_config = get_aws_config()
 
             if st.button("Process Vector DB", key="process_btn"):
-                with st.spinner("Processing..."):
-                    documents = load_documents(source_type, folder_name, bucket_name)
-                    if documents:
-                        if action == "Create new vector database":
-                            db_path = VECTOR_DB_DIR / db_name
-                            if db_path.exists():
-                                resync = st.checkbox(f"Vector database '{db_name}' already exists. Do you want to resync it?")
-                                if resync:
-                                    resync_vector_db(db_name, documents, threshold_type)
-                            else:
-                                create_vector_db(documents, db_name, threshold_type)
-                        else:  # Resync existing vector database
-                            resync_vector_db(db_name, documents, threshold_type)
+                if not db_name:
+                    st.warning("Invalid Vector Database Name.")
+                    st.stop()
+                if action == "Create new vector database":
+                    db_path = VECTOR_DB_DIR / db_name
+                    if db_path.exists():
+                        resync = st.checkbox(f"Vector database '{db_name}' already exists. Do you want to resync it?")
+                        if resync:
+                            submit_build("resync", db_name, threshold_type, source_type, folder_name, bucket_name,
+                                         chunk_vectors, aws_config)
+                    else:
+                        submit_build("create", db_name, threshold_type, source_type, folder_name, bucket_name,
+                                     chunk_vectors, aws_config)
+                else:  # Resync existing vector database
+                    submit_build("resync", db_name, threshold_type, source_type, folder_name, bucket_name,
+                                 chunk_vectors, aws_config)
 
         elif action == "Delete vector database":
             vector_databases = [x.name for x in VECTOR_DB_DIR.iterdir() if x.is_dir()]
@@ -209,4 +243,5 @@ def main():
                     delete_vector_db(db_name)
 
     st.markdown("---")
+    show_jobs()
     st.info("👆 Use the options above to manage your vector databases.")
\ No newline at end of file
@@ -0,0 +1,117 @@
+# vector_db_manifest.py
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+@dataclass
+class ManifestDiff:
+    """Files of a source compared against the manifest of a vector DB."""
+    added: dict = field(default_factory=dict)
+    modified: dict = field(default_factory=dict)
+    deleted: list = field(default_factory=list)
+    unchanged: dict = field(default_factory=dict)
+
+    @property
+    def changed(self):
+        return bool(self.added or self.modified or self.deleted)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint_file(path):
+    """Return the size, mtime and content hash of a local file."""
+    stat = Path(path).stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": hash_file(path)}
+
+
+def new_manifest(threshold_type, source_type, source):
+    return {
+        "version": MANIFEST_VERSION,
+        "threshold_type": threshold_type,
+        "source_type": source_type,
+        "source": source,
+        "files": {},
+    }
+
+
+def load_manifest(db_path):
+    manifest_path = Path(db_path) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(db_path, manifest):
+    """Write the manifest next to the index, replacing the old one atomically."""
+    manifest_path = Path(db_path) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def diff_local_folder(manifest, folder):
+    """Compare the files of a local folder with the manifest.
+
+    Files whose size and mtime match the manifest are treated as unchanged
+    without being read; everything else is hashed so that a touched but
+    identical file is not re-processed.
+    """
+    diff = ManifestDiff()
+    known = manifest["files"]
+    seen = set()
+    for path in Path(folder).iterdir():
+        if not path.is_file():
+            continue
+        seen.add(path.name)
+        entry = known.get(path.name)
+        stat = path.stat()
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            diff.unchanged[path.name] = entry
+            continue
+        fingerprint = fingerprint_file(path)
+        if entry is None:
+            diff.added[path.name] = fingerprint
+        elif entry["sha256"] == fingerprint["sha256"]:
+            diff.unchanged[path.name] = {**entry, **fingerprint}
+        else:
+            diff.modified[path.name] = fingerprint
+    diff.deleted = [name for name in known if name not in seen]
+    return diff
+
+
+def diff_objects(manifest, fingerprints):
+    """Compare listed objects ({name: {"size", "etag"}}, e.g. from S3) with the manifest.
+
+    An object is unchanged when its ETag and size match the last sync, so
+    nothing has to be downloaded to find out.
+    """
+    diff = ManifestDiff()
+    known = manifest["files"]
+    for name, fingerprint in fingerprints.items():
+        entry = known.get(name)
+        if entry is None:
+            diff.added[name] = fingerprint
+        elif entry.get("etag") == fingerprint["etag"] and entry["size"] == fingerprint["size"]:
+            diff.unchanged[name] = entry
+        else:
+            diff.modified[name] = fingerprint
+    diff.deleted = [name for name in known if name not in fingerprints]
+    return diff
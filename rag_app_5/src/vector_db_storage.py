@@ -0,0 +1,438 @@
+# vector_db_storage.py
+"""On-disk format of a vector DB version, without pickle.
+
+A version directory holds:
+    index.faiss       the FAISS index (faiss.write_index), flat or ANN (see ann_index)
+    index.json        index type, parameters and build report
+    vectors.f32       full-precision vectors by position, when index.faiss is not flat
+    docstore.sqlite   chunk id, text, JSON metadata and MinHash signature (see dedup)
+                      keyed by index position, plus an FTS5 full-text index of the
+                      text for BM25 search
+
+For serving, the index is opened memory-mapped where the installed FAISS
+supports it and chunks are read from SQLite only when a search returns
+them. Builds load everything into memory so the index can be modified.
+
+DBs saved with FAISS.save_local (index.pkl) are migrated when they are
+first loaded or resynced (see migrate_if_legacy). All DBs, including those
+saved before the full-text index existed, can be migrated at once with:
+    python vector_db_storage.py [--root ~/.ragbot/vector_dbs]
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from ann_index import RescoringIndex
+from vector_db_versions import current_version, list_versions, version_name, new_staging_dir, publish_version
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.faiss"
+INDEX_INFO_FILE = "index.json"
+VECTORS_FILE = "vectors.f32"
+DOCSTORE_FILE = "docstore.sqlite"
+LEGACY_DOCSTORE_FILE = "index.pkl"
+# External-content FTS5 table over docs.text: only the inverted index is stored, not a second copy of the text
+LEXICAL_TABLE = "docs_fts"
+# IO_FLAG_MMAP_IFC (memory-mapped flat codes) only exists in newer FAISS releases;
+# older ones still map IVF inverted lists with IO_FLAG_MMAP.
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+# Serialises automatic migrations, so a DB opened by several sessions at once is converted only once
+_migrate_lock = threading.Lock()
+
+
+class LegacyFormatError(Exception):
+    pass
+
+
+class SqliteDocstore(Docstore):
+    """Read-only docstore that fetches chunks from docstore.sqlite by id."""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.has_lexical_index = has_lexical_index(self._db)
+
+    def execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def search(self, search):
+        rows = self.execute("SELECT text, metadata FROM docs WHERE id = ?", (search,))
+        if not rows:
+            return f"ID {search} not found."
+        text, metadata = rows[0]
+        return Document(id=search, page_content=text, metadata=json.loads(metadata))
+
+    def lexical_search(self, match, k):
+        """BM25 search of the chunk text; `match` is an FTS5 query. Returns (Document, score), best first."""
+        rows = self.execute(f"SELECT d.id, d.text, d.metadata, f.rank FROM {LEXICAL_TABLE} f "
+                            f"JOIN docs d ON d.rowid = f.rowid WHERE {LEXICAL_TABLE} MATCH ? "
+                            f"ORDER BY f.rank LIMIT ?", (match, k))
+        # FTS5 ranks by negated BM25 so that smaller is better
+        return [(Document(id=id_, page_content=text, metadata=json.loads(metadata)), -rank)
+                for id_, text, metadata, rank in rows]
+
+    def positions(self, ids):
+        """FAISS position of each of `ids` that is in the docstore, as {id: position}."""
+        ids = list(ids)
+        if not ids:
+            return {}
+        rows = self.execute(f"SELECT id, position FROM docs WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        return dict(rows)
+
+    def add(self, texts):
+        raise NotImplementedError("SqliteDocstore is read-only")
+
+
+class DocstoreIndexMap(Mapping):
+    """FAISS position -> chunk id, looked up in a SqliteDocstore instead of held in memory."""
+
+    def __init__(self, docstore):
+        self.docstore = docstore
+        self._len = docstore.execute("SELECT COUNT(*) FROM docs")[0][0]
+
+    def __getitem__(self, position):
+        rows = self.docstore.execute("SELECT id FROM docs WHERE position = ?", (int(position),))
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def __iter__(self):
+        return (position for (position,) in self.docstore.execute("SELECT position FROM docs ORDER BY position"))
+
+    def __len__(self):
+        return self._len
+
+
+def has_lexical_index(db):
+    return bool(db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (LEXICAL_TABLE,)).fetchall())
+
+
+def write_lexical_index(db):
+    """(Re)build the BM25 full-text index of the docs table in an open docstore."""
+    db.execute(f"DROP TABLE IF EXISTS {LEXICAL_TABLE}")
+    # Keyed by the rowid of docs: seq, or position in docstores written before seq existed
+    db.execute(f"CREATE VIRTUAL TABLE {LEXICAL_TABLE} USING fts5(text, content='docs')")
+    db.execute(f"INSERT INTO {LEXICAL_TABLE}({LEXICAL_TABLE}) VALUES ('rebuild')")
+    db.execute(f"INSERT INTO {LEXICAL_TABLE}({LEXICAL_TABLE}) VALUES ('optimize')")
+
+
+def docstore_rows(docstore, items, signatures):
+    """(position, id, text, metadata, minhash) rows of the (position, id) `items` of an in-memory docstore."""
+    for position, id_ in items:
+        document, signature = docstore.search(id_), signatures.get(id_)
+        yield (position, id_, document.page_content, json.dumps(document.metadata, default=str),
+               signature.tobytes() if signature is not None else None)
+
+
+def can_update_docstore(base, index_to_docstore_id, lexical_index):
+    """Whether the docstore of the saved version `base` can be updated into one for `index_to_docstore_id`.
+
+    Docstores written before seq existed key the full-text index by position,
+    which changes whenever chunks are deleted, and a docstore sharing less
+    than half of the chunks is quicker to write from scratch.
+    """
+    base_path = Path(base) / DOCSTORE_FILE
+    if not base_path.exists():
+        return False
+    db = sqlite3.connect(f"file:{base_path}?mode=ro", uri=True)
+    try:
+        if "seq" not in {column for _, column, *_ in db.execute("PRAGMA table_info(docs)")}:
+            return False
+        if lexical_index and not has_lexical_index(db):
+            return False
+        ids = set(index_to_docstore_id.values())
+        return sum(id_ in ids for (id_,) in db.execute("SELECT id FROM docs")) * 2 >= len(ids)
+    finally:
+        db.close()
+
+
+def update_docstore(db, docstore, index_to_docstore_id, signatures):
+    """Turn the chunks of an open docstore into those of an in-memory one, keeping the full-text index in sync.
+
+    Chunk texts never change under an id, so only removed and added chunks
+    touch the full-text index; kept chunks get their new position, metadata
+    (e.g. the sources of merged near-duplicates) and missing signature.
+    """
+    positions = {id_: position for position, id_ in index_to_docstore_id.items()}
+    stored = {id_: (position, metadata, has_signature) for id_, position, metadata, has_signature
+              in db.execute("SELECT id, position, metadata, minhash IS NOT NULL FROM docs")}
+    lexical_index = has_lexical_index(db)
+    removed = [(id_,) for id_ in stored if id_ not in positions]
+    if lexical_index:
+        # External-content FTS5 rows are deleted by passing the text they were indexed with
+        db.executemany(f"INSERT INTO {LEXICAL_TABLE}({LEXICAL_TABLE}, rowid, text) "
+                       f"SELECT 'delete', seq, text FROM docs WHERE id = ?", removed)
+    db.executemany("DELETE FROM docs WHERE id = ?", removed)
+
+    updated = []
+    for id_, (position, metadata, has_signature) in stored.items():
+        if id_ not in positions:
+            continue
+        new_metadata = json.dumps(docstore.search(id_).metadata, default=str)
+        signature = None if has_signature else signatures.get(id_)
+        if positions[id_] != position or new_metadata != metadata or signature is not None:
+            updated.append((positions[id_], new_metadata, signature.tobytes() if signature is not None else None, id_))
+    db.executemany("UPDATE docs SET position = ?, metadata = ?, minhash = COALESCE(?, minhash) WHERE id = ?", updated)
+
+    last_seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM docs").fetchone()[0]
+    added = sorted((position, id_) for id_, position in positions.items() if id_ not in stored)
+    db.executemany("INSERT INTO docs (position, id, text, metadata, minhash) VALUES (?, ?, ?, ?, ?)",
+                   docstore_rows(docstore, added, signatures))
+    if lexical_index:
+        db.execute(f"INSERT INTO {LEXICAL_TABLE}(rowid, text) SELECT seq, text FROM docs WHERE seq > ?", (last_seq,))
+    logger.info(f"Docstore updated: {len(removed)} chunks removed, {len(added)} added, {len(updated)} changed")
+
+
+def write_docstore(path, docstore, index_to_docstore_id, lexical_index=True, signatures=None, base=None):
+    """Write the chunks of an in-memory docstore to `path`/docstore.sqlite, replacing it atomically.
+
+    With `lexical_index` the full-text index is written along with the chunks,
+    so it always matches the version it is published in. `signatures`
+    ({id: MinHash signature}) are stored with the chunks that have one. With
+    `base`, a saved version of the same DB, its docstore is copied and
+    updated with the chunks that changed (see update_docstore) rather than
+    written and indexed from scratch.
+    """
+    signatures = signatures or {}
+    path = Path(path)
+    tmp_path = path / (DOCSTORE_FILE + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    if base is not None and can_update_docstore(base, index_to_docstore_id, lexical_index):
+        shutil.copyfile(Path(base) / DOCSTORE_FILE, tmp_path)
+        db = sqlite3.connect(tmp_path)
+        update_docstore(db, docstore, index_to_docstore_id, signatures)
+    else:
+        db = sqlite3.connect(tmp_path)
+        # seq is the stable key of the full-text index; positions shift when chunks are deleted
+        db.execute("CREATE TABLE docs (seq INTEGER PRIMARY KEY, position INTEGER NOT NULL, id TEXT NOT NULL UNIQUE, "
+                   "text TEXT NOT NULL, metadata TEXT NOT NULL, minhash BLOB)")
+        db.execute("CREATE INDEX docs_position ON docs (position)")
+        db.executemany("INSERT INTO docs (position, id, text, metadata, minhash) VALUES (?, ?, ?, ?, ?)",
+                       docstore_rows(docstore, sorted(index_to_docstore_id.items()), signatures))
+        if lexical_index:
+            write_lexical_index(db)
+    db.commit()
+    db.close()
+    os.replace(tmp_path, path / DOCSTORE_FILE)
+
+
+def load_signatures(path):
+    """MinHash signatures stored with the chunks of a saved DB, as {id: signature}."""
+    db = sqlite3.connect(f"file:{Path(path) / DOCSTORE_FILE}?mode=ro", uri=True)
+    try:
+        # Docstores written before signatures were stored have no minhash column
+        if "minhash" not in {column for _, column, *_ in db.execute("PRAGMA table_info(docs)")}:
+            return {}
+        return {id_: np.frombuffer(signature, dtype=np.uint32)
+                for id_, signature in db.execute("SELECT id, minhash FROM docs WHERE minhash IS NOT NULL")}
+    finally:
+        db.close()
+
+
+def flat_vectors(index):
+    """The vectors of a flat index as an (n, d) array, without copying them."""
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+
+def load_index_info(path):
+    """Index type and parameters of a saved DB; DBs saved before index types were selectable are flat."""
+    info_path = Path(path) / INDEX_INFO_FILE
+    if not info_path.exists():
+        return {"type": "flat", "params": {}}
+    with open(info_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_vector_db(vector_db, path, index=None, info=None, lexical_index=True, signatures=None, base=None):
+    """Save a DB built on a flat index.
+
+    `index` (e.g. an ANN index built from the same vectors) is written to
+    index.faiss instead of the flat one; the full-precision vectors are then
+    kept in vectors.f32 so later builds can still edit them. `info`
+    describes the index and is stored in index.json. Checkpoints, which are
+    never searched, skip the full-text index. `signatures` are the MinHash
+    signatures of the chunks, kept so that later builds need not recompute them.
+    `base` is an earlier version whose docstore is updated rather than
+    rewritten (see write_docstore).
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    faiss.write_index(index or vector_db.index, str(path / INDEX_FILE))
+    if index is not None:
+        flat_vectors(vector_db.index).tofile(path / VECTORS_FILE)
+    info = {"type": "flat", "params": {}, **(info or {}),
+            "dim": vector_db.index.d, "count": vector_db.index.ntotal}
+    with open(path / INDEX_INFO_FILE, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=1)
+    write_docstore(path, vector_db.docstore, vector_db.index_to_docstore_id, lexical_index, signatures, base)
+
+
+def append_vector_db(vector_db, path, saved=0, signatures=None):
+    """Checkpoint the flat working DB of a build to `path`, which holds its first `saved` vectors.
+
+    Only the vectors added since are appended to vectors.f32 and the
+    docstore is updated in place (see update_docstore), so a checkpoint
+    costs what changed since the last one; with `saved` 0 everything is
+    written. The full-text index is left out, as checkpoints are never
+    searched. Returns the number of vectors now saved.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    vectors = flat_vectors(vector_db.index)
+    with open(path / VECTORS_FILE, "r+b" if saved else "wb") as f:
+        # Also drops whatever an interrupted checkpoint appended after the first `saved` vectors
+        f.truncate(saved * vectors.shape[1] * vectors.itemsize)
+        f.seek(0, os.SEEK_END)
+        vectors[saved:].tofile(f)
+    if saved:
+        db = sqlite3.connect(path / DOCSTORE_FILE)
+        update_docstore(db, vector_db.docstore, vector_db.index_to_docstore_id, signatures or {})
+        db.commit()
+        db.close()
+    else:
+        write_docstore(path, vector_db.docstore, vector_db.index_to_docstore_id, False, signatures)
+    with open(path / INDEX_INFO_FILE, "w", encoding="utf-8") as f:
+        json.dump({"type": "flat", "params": {}, "dim": vector_db.index.d, "count": vector_db.index.ntotal}, f)
+    return len(vectors)
+
+
+def load_vector_db(path, embeddings, lazy=True):
+    """Open a saved vector DB.
+
+    With `lazy` the index is memory-mapped and read-only, chunks stay in
+    SQLite, and compressed indexes built with re-scoring re-rank their
+    candidates with the full-precision vectors memory-mapped from vectors.f32.
+    Otherwise everything is loaded into a flat index so the DB can be modified.
+    """
+    path = Path(path)
+    if not (path / DOCSTORE_FILE).exists():
+        if (path / LEGACY_DOCSTORE_FILE).exists():
+            raise LegacyFormatError(f"{path} is in the old pickle format. "
+                                    f"Run `python vector_db_storage.py` to migrate it.")
+        raise FileNotFoundError(f"No vector DB found in {path}")
+    if lazy:
+        index = faiss.read_index(str(path / INDEX_FILE), MMAP_FLAGS)
+        info = load_index_info(path)
+        if info.get("rescore") and (path / VECTORS_FILE).exists():
+            vectors = np.memmap(path / VECTORS_FILE, dtype=np.float32, mode="r", shape=(info["count"], info["dim"]))
+            index = RescoringIndex(index, vectors)
+        docstore = SqliteDocstore(path / DOCSTORE_FILE)
+        return FAISS(embeddings, index, docstore, DocstoreIndexMap(docstore))
+
+    if (path / VECTORS_FILE).exists():
+        dim = load_index_info(path)["dim"]
+        index = faiss.IndexFlatL2(dim)
+        index.add(np.fromfile(path / VECTORS_FILE, dtype=np.float32).reshape(-1, dim))
+    else:
+        index = faiss.read_index(str(path / INDEX_FILE))
+    documents = {}
+    index_to_docstore_id = {}
+    db = sqlite3.connect(path / DOCSTORE_FILE)
+    for position, id_, text, metadata in db.execute("SELECT position, id, text, metadata FROM docs ORDER BY position"):
+        documents[id_] = Document(id=id_, page_content=text, metadata=json.loads(metadata))
+        index_to_docstore_id[position] = id_
+    db.close()
+    return FAISS(embeddings, index, InMemoryDocstore(documents), index_to_docstore_id)
+
+
+def migrate_directory(path):
+    """Convert a directory saved by FAISS.save_local in place. The pickle is only read here."""
+    path = Path(path)
+    with open(path / LEGACY_DOCSTORE_FILE, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    write_docstore(path, docstore, index_to_docstore_id)
+    (path / LEGACY_DOCSTORE_FILE).unlink()
+
+
+def add_lexical_index(path):
+    """Add the full-text index to a docstore written before it existed; returns whether one was added.
+
+    Readers only ever see the docs table, so this is safe on a live version.
+    """
+    db = sqlite3.connect(Path(path) / DOCSTORE_FILE)
+    try:
+        if has_lexical_index(db):
+            return False
+        write_lexical_index(db)
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def migrate_database(db_path):
+    """Migrate every pickled or unindexed version of one DB; returns the number of directories converted."""
+    db_path = Path(db_path)
+    migrated = 0
+    for number in list_versions(db_path):
+        version_path = db_path / version_name(number)
+        if (version_path / LEGACY_DOCSTORE_FILE).exists():
+            migrate_directory(version_path)
+            migrated += 1
+        elif (version_path / DOCSTORE_FILE).exists() and add_lexical_index(version_path):
+            migrated += 1
+    if (db_path / LEGACY_DOCSTORE_FILE).exists():
+        # DB from before versioning: migrate a copy and publish it as a version
+        staging = new_staging_dir(db_path)
+        for name in [INDEX_FILE, LEGACY_DOCSTORE_FILE, "manifest.json"]:
+            if (db_path / name).exists():
+                shutil.copy2(db_path / name, staging / name)
+        migrate_directory(staging)
+        publish_version(db_path, staging)
+        migrated += 1
+    return migrated
+
+
+def is_legacy(path):
+    """Whether a version directory is still in the pickle format."""
+    path = Path(path)
+    return not (path / DOCSTORE_FILE).exists() and (path / LEGACY_DOCSTORE_FILE).exists()
+
+
+def migrate_if_legacy(db_path):
+    """Migrate the DB if its live version is in the pickle format, so that it can be loaded.
+
+    Returns whether it was migrated; a DB from before versioning is
+    published as a new version.
+    """
+    with _migrate_lock:
+        _, path = current_version(db_path)
+        if path is None or not is_legacy(path):
+            return False
+        logger.info(f"Migrating {db_path} from the pickle format")
+        migrate_database(db_path)
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=str(Path.home() / ".ragbot" / "vector_dbs"),
+                        help="Directory containing the vector DBs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    for db_path in sorted(Path(args.root).expanduser().iterdir()):
+        if db_path.is_dir():
+            migrated = migrate_database(db_path)
+            print(f"{db_path.name}: {migrated} version(s) migrated" if migrated else f"{db_path.name}: up to date")
+
+
+if __name__ == "__main__":
+    main()
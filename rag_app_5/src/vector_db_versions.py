@@ -0,0 +1,99 @@
+# vector_db_versions.py
+import logging
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Layout of a vector DB directory:
+#   <db>/v000003/       one published build (see vector_db_storage) and its manifest.json
+#   <db>/CURRENT        name of the live version, replaced atomically on publish
+#   <db>/.staging-*     builds being written
+# DBs created before versioning keep their files directly in <db>/ until
+# their next build is published.
+POINTER_FILE = "CURRENT"
+STAGING_PREFIX = ".staging-"
+# The previous version is kept so readers that just resolved it can finish loading.
+KEEP_VERSIONS = 2
+VERSION_PATTERN = re.compile(r"^v(\d{6,})$")
+
+
+def version_name(number):
+    return f"v{number:06d}"
+
+
+def list_versions(db_path):
+    """Published version numbers of a DB, oldest first."""
+    db_path = Path(db_path)
+    if not db_path.is_dir():
+        return []
+    return sorted(int(match.group(1)) for path in db_path.iterdir()
+                  if path.is_dir() and (match := VERSION_PATTERN.match(path.name)))
+
+
+def current_version(db_path):
+    """Return (version name, directory) of the live version, or (None, None) if nothing is published."""
+    db_path = Path(db_path)
+    try:
+        name = (db_path / POINTER_FILE).read_text(encoding="utf-8").strip()
+        return name, db_path / name
+    except FileNotFoundError:
+        pass
+    if (db_path / "index.faiss").exists():
+        return "legacy", db_path
+    return None, None
+
+
+def version_signature(db_path):
+    """Cheap change detector: the stat of the pointer file, which every publish replaces."""
+    db_path = Path(db_path)
+    for name in [POINTER_FILE, "index.faiss"]:
+        try:
+            stat = (db_path / name).stat()
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def list_databases(root):
+    """Names of the DBs under `root` that have a published version."""
+    return sorted(path.name for path in Path(root).iterdir()
+                  if path.is_dir() and current_version(path)[0] is not None)
+
+
+def new_staging_dir(db_path):
+    staging = Path(db_path) / f"{STAGING_PREFIX}{uuid.uuid4().hex}"
+    staging.mkdir(parents=True)
+    return staging
+
+
+def publish_version(db_path, staging):
+    """Publish a fully written staging directory as the DB's new live version.
+
+    The directory is renamed to the next version number and the pointer file
+    is swapped with os.replace, so readers see either the old version or the
+    new one, never a partial build. Versions older than the last
+    KEEP_VERSIONS are removed afterwards.
+    """
+    db_path = Path(db_path)
+    name = version_name(max(list_versions(db_path), default=0) + 1)
+    os.replace(staging, db_path / name)
+    tmp_path = db_path / (POINTER_FILE + ".tmp")
+    tmp_path.write_text(name, encoding="utf-8")
+    os.replace(tmp_path, db_path / POINTER_FILE)
+    logger.info(f"Published {db_path.name} {name}")
+    prune_versions(db_path)
+    return name
+
+
+def prune_versions(db_path):
+    db_path = Path(db_path)
+    for number in list_versions(db_path)[:-KEEP_VERSIONS]:
+        shutil.rmtree(db_path / version_name(number), ignore_errors=True)
+    # Files of a DB published before versioning
+    for name in ["index.faiss", "index.pkl", "docstore.sqlite", "manifest.json"]:
+        (db_path / name).unlink(missing_ok=True)
@@ -1,36 +1,129 @@
-import streamlit as st
+import heapq
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from langchain_community.vectorstores import FAISS
-from models import setup_embedding_model
+from typing import Any
+
+import streamlit as st
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from models import setup_query_embedding_model
+from hybrid_search import hybrid_search
+from index_registry import IndexRegistry
+from startup import record_last_used
+from vector_db_versions import list_databases
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DB_DIR = Path.home() / ".ragbot" / "vector_dbs"
+
+# Shared by all sessions; a query fans out to one task per selected DB
+_search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="db-search")
+
+
+@st.cache_resource
+def get_index_registry():
+    """One registry per server process, so sessions using the same DB share one copy of it."""
+    return IndexRegistry(VECTOR_DB_DIR, setup_query_embedding_model())
+
+
+class RegistryRetriever(BaseRetriever):
+    """Retriever over one or more DBs, pinning the live version of each in the shared registry per query.
+
+    In "hybrid" mode BM25 and dense results are fused (see hybrid_search);
+    "similarity" is dense search only. Several DBs are searched in parallel
+    with one query embedding and their results merged into a global top k
+    by dense similarity to the query, which is comparable across DBs as they
+    share the embedding model. Each document gets its DB name in
+    metadata["db"] and the latency in ms of each stage and DB in
+    metadata["retrieval_ms"].
+    """
+
+    registry: Any
+    db_names: list[str]
+    mode: str = "hybrid"
+    search_kwargs: dict = {"k": 5}
+
+    def _search_db(self, db_name, query, embedding):
+        start = time.perf_counter()
+        with self.registry.acquire(db_name) as vector_db:
+            if self.mode == "hybrid":
+                results, timings = hybrid_search(vector_db, query, embedding=embedding, **self.search_kwargs)
+            else:
+                timings = {}
+                if embedding is None:
+                    embedding = vector_db.embedding_function.embed_query(query)
+                # Smaller L2 distances map to scores closer to 1
+                results = [(document, 1 / (1 + distance)) for document, distance
+                           in vector_db.similarity_search_with_score_by_vector(embedding, **self.search_kwargs)]
+        for document, _ in results:
+            document.metadata["db"] = db_name
+        timings["total"] = (time.perf_counter() - start) * 1000
+        return results, timings
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        start = time.perf_counter()
+        if len(self.db_names) == 1:
+            results, timings = self._search_db(self.db_names[0], query, None)
+            timings["per_db"] = {self.db_names[0]: timings["total"]}
+        else:
+            # The DBs share the embedding model, so the query is embedded once
+            embedding = self.registry.embeddings.embed_query(query)
+            timings = {"embed": (time.perf_counter() - start) * 1000, "per_db": {}}
+            futures = {db_name: _search_pool.submit(self._search_db, db_name, query, embedding)
+                       for db_name in self.db_names}
+            results, errors = [], []
+            for db_name, future in futures.items():
+                try:
+                    db_results, db_timings = future.result()
+                except Exception as e:
+                    logger.exception(f"Search of {db_name} failed")
+                    errors.append(e)
+                    continue
+                results.extend(db_results)
+                timings["per_db"][db_name] = db_timings["total"]
+            if len(errors) == len(futures):
+                raise errors[0]
+            results = heapq.nlargest(self.search_kwargs.get("k", 5), results, key=lambda pair: pair[1])
+            timings["total"] = (time.perf_counter() - start) * 1000
+        documents = [document for document, _ in results]
+        for document in documents:
+            document.metadata["retrieval_ms"] = timings
+        return documents
+
 
 class VectorStore:
     def __init__(self):
-        self.index_path = Path.home() / ".ragbot" / "vector_dbs"
+        self.index_path = VECTOR_DB_DIR
         if "vector_store" not in st.session_state:
             st.session_state.vector_store = None
         if "current_vector_db" not in st.session_state:
             st.session_state.current_vector_db = None
 
     def get_available_vector_dbs(self):
-        return [file.name for file in self.index_path.glob('*') if file.is_dir()]
+        return list_databases(self.index_path)
 
-    def load_vector_store(self, selected_vector):
-        if selected_vector and selected_vector != st.session_state.current_vector_db:
+    def load_vector_store(self, selected_vectors):
+        """Select the DBs (a list of names) that the session's retriever searches."""
+        if selected_vectors and selected_vectors != st.session_state.current_vector_db:
             try:
-                st.session_state.vector_store = FAISS.load_local(
-                    str(self.index_path / selected_vector),
-                    embeddings=setup_embedding_model(),
-                    allow_dangerous_deserialization=True
-                )
-                st.session_state.current_vector_db = selected_vector
-                st.toast(f"{selected_vector} loaded successfully.")
+                # Loads the DBs into the shared registry unless another session already did
+                for selected_vector in selected_vectors:
+                    with get_index_registry().acquire(selected_vector):
+                        pass
+                st.session_state.vector_store = list(selected_vectors)
+                st.session_state.current_vector_db = list(selected_vectors)
+                record_last_used(selected_vectors)
+                st.toast(f"{', '.join(selected_vectors)} loaded successfully.")
             except Exception as e:
                 st.error(f'Error loading vector store: {e}')
                 st.session_state.vector_store = None
                 st.session_state.current_vector_db = None
         return st.session_state.vector_store
 
-    def get_retriever(self):
+    def get_retriever(self, k=5):
         if st.session_state.vector_store:
-            return st.session_state.vector_store.as_retriever(search_type="similarity", search_kwargs={"k": 5})
-        return None
\ No newline at end of file
+            return RegistryRetriever(registry=get_index_registry(), db_names=st.session_state.vector_store,
+                                     search_kwargs={"k": k})
+        return None